@@ -0,0 +1,96 @@
+"""
+Action plugin for cac_server.
+
+Runs cac_server on the controller, in the worker process Ansible already has for each host, instead of copying the
+module and starting a new process for it.  All hosts of a batch running the same task share one listservers and
+listtemplates snapshot (see cloudatcost_ansible_module.snapshot), so a per-host cac_server task with
+delegate_to: localhost costs one read for the whole batch, rather than one per host.  Each host still gets its own
+changed/failed result.
+
+Credentials come from the api_user and api_key arguments, the task's environment, or the controller's CAC_API_USER
+and CAC_API_KEY, in that order.  If there are none, or the task's environment sets variables that only the module
+reads (CAC_STATUS_BROKER, CAC_CASSETTE), the module is run as usual.
+
+Enable it by adding this directory to action_plugins in ansible.cfg.  Set CAC_ACTION_PLUGIN=0 to run the module as
+usual.
+"""
+import os
+
+from ansible.errors import AnsibleError
+from ansible.plugins.action import ActionBase
+
+try:
+    from cloudatcost_ansible_module import cac_server, snapshot
+
+    HAS_CAC = cac_server.HAS_CAC
+except ImportError:
+    HAS_CAC = False
+
+# Read by the module from its own environment, which the controller's os.environ doesn't have
+MODULE_ONLY_ENVIRONMENT = ('CAC_STATUS_BROKER', 'CAC_CASSETTE', 'CAC_ACTION_PLUGIN')
+
+
+class ActionModule(ActionBase):
+    TRANSFERS_FILES = False
+
+    def _task_environment(self):
+        """ Return the task's environment keyword, templated and merged as Ansible does for the module """
+        environment = {}
+        entries = self._task.environment
+        if not isinstance(entries, list):
+            entries = [entries]
+        # Inherited entries come after the task's own, which take precedence.  Not reversed in place, as
+        # _execute_module() reverses the same list.
+        for entry in reversed(entries):
+            if entry is None:
+                continue
+            entry = self._templar.template(entry)
+            if not isinstance(entry, dict):
+                raise AnsibleError("environment must be a dictionary, received %s (%s)" % (entry, type(entry)))
+            environment.update(entry)
+        return environment
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        if not HAS_CAC or os.environ.get('CAC_ACTION_PLUGIN') == '0':
+            return self._execute_module(tmp=tmp, task_vars=task_vars)
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        try:
+            params = cac_server.module_params(self._task.args)
+            environment = self._task_environment()
+        except (TypeError, ValueError, AnsibleError) as e:
+            result.update(failed=True, msg='%s' % e)
+            return result
+
+        api_user = params.get('api_user') or environment.get('CAC_API_USER') or os.environ.get('CAC_API_USER')
+        api_key = params.get('api_key') or environment.get('CAC_API_KEY') or os.environ.get('CAC_API_KEY')
+        if not (api_user and api_key) or any(name in environment for name in MODULE_ONLY_ENVIRONMENT):
+            return self._execute_module(tmp=tmp, task_vars=task_vars)
+
+        # The snapshot is shared by the hosts of this batch running this task, with the same account.
+        batch = task_vars.get('ansible_play_batch') or [task_vars.get('inventory_hostname')]
+        key = '%s %s %s' % (api_user, self._task._uuid, ','.join(sorted(batch)))
+        deadline = cac_server.Deadline(params.get('timeout') or int(params.get('wait_timeout')) + 60)
+
+        try:
+            with deadline.phase('connect'):
+                api = cac_server.get_api(api_user, api_key, deadline, check=False)
+                servers = snapshot.shared_snapshot(api, key, check=False)
+            outcome = cac_server.reconcile(api, params, servers, deadline, self._play_context.check_mode)
+        except cac_server.DeadlineExceeded as e:
+            result.update(failed=True, msg='%s' % e, timings=deadline.timings())
+            return result
+        except Exception as e:
+            result.update(failed=True, msg='%s' % e)
+            return result
+
+        if outcome['changed'] and not self._play_context.check_mode:
+            snapshot.invalidate(key)
+        if outcome['server'] is not None:
+            outcome['server'] = dict(outcome['server'])
+        result.update(outcome)
+        return result
@@ -3,6 +3,49 @@
 CloudAtCost external inventory script. Automatically finds hosts and
 returns them under the host group 'cloudatcost'
 
+Servers from several CloudAtCost accounts can be merged into one inventory
+by listing the accounts in cac_inv.ini (or the file named by the
+CAC_INI_PATH environment variable):
+
+    [defaults]
+    cache_path = ~/.ansible/tmp
+    cache_max_age = 300
+    # For this many seconds after cache_max_age, answer from the cache at
+    # once, and refresh it in the background
+    stale_while_revalidate = 3600
+    # Only keep these listservers fields (default: all)
+    fields = sid, label, ip, status, template
+    # Keep servers in an indexed SQLite store, to answer --host and --query
+    # without calling the API
+    store_path = ~/.ansible/tmp/cloudatcost.sqlite
+    # Only put these fields in hostvars (default: all), and never these
+    hostvars_include = sid, label, status, template
+    hostvars_exclude = rootpass, vncpass
+    # Only put ansible_host and cloud_sid, cloud_label, cloud_status and
+    # cloud_account in hostvars, and print compact JSON
+    hostvars_minimal = yes
+
+    [account:personal]
+    api_user = bob@smith.com
+    api_key = longStringFromCACApi
+
+    [account:work]
+    api_user = bob@work.com
+    api_key = anotherLongStringFromCACApi
+
+Each account's servers are also placed in a 'cloudatcost_<account>' group.
+Without any accounts configured, the CAC_API_USER and CAC_API_KEY
+environment variables are used, as the 'default' account.
+
+--query prints the servers matching all of a comma-separated list of
+field=value criteria, ie. --query status=Installing,template=CentOS-7-64bit
+The fields that can be queried are: sid, label, ip, status, template, account
+
+--report prints utilization percentiles, over- and under-provisioned
+servers, and totals by template, mode and status, as JSON or (with
+--report-format csv) CSV.  It needs the cpu, ram, storage, cpuusage,
+ramusage and hdusage fields.
+
 Some code borrowed from linode.py inventory script by Dan Slimmon
 
 """
@@ -11,9 +54,16 @@ import os.path
 # import re
 import sys
 import argparse
-# from time import time
+import fcntl
+import subprocess
+import tempfile
+from time import time
+from multiprocessing.pool import ThreadPool
 from cacpy import CACPy
-# import ConfigParser
+import ConfigParser
+from cloudatcost_ansible_module.fleet_report import fleet_report, write_csv
+from cloudatcost_ansible_module.fleet_store import FleetStore
+from cloudatcost_ansible_module.stream import iter_server_info
 
 
 try:
@@ -23,60 +73,235 @@ except ImportError:
 
 _group = 'cloudatcost'  # a default group
 _prepend = 'cloud_'  # Prepend all CloudAtCost data, to avoid conflicts
+_minimal_hostvars = ('sid', 'label', 'status', 'account')  # Server fields kept by hostvars_minimal
 
 
 class CloudAtCostInventory(object):
     def __init__(self):
         """Main execution path."""
-        self.api_key = None
-        self.api_user = None
-
         self.args = self.parse_cli_args()
-        self.inventory = {}
+        self.inventory = []
+        self.servers_by_label = {}
+        self.accounts = []
+        self.account_inventory = {}
+        self.cache_path = os.path.expanduser('~/.ansible/tmp')
+        self.cache_max_age = 0
+        self.stale_while_revalidate = 0
+        self.revalidate = False
+        self.fields = None
+        self.store = None
+        self.hostvars_include = None
+        self.hostvars_exclude = set()
+        self.hostvars_minimal = False
+
+        self.read_settings()
 
-        # CloudAtCost API Object
-        self.setupAPI()
+        if self.args.revalidate:
+            # Detached background refresh, started by another run that answered from a stale cache
+            self.refresh_in_background()
+            return
 
-        self.update_inventory()
+        if (self.args.host or self.args.query) and self.store_is_complete():
+            # Answer from the store, without calling the API
+            pass
+        else:
+            self.update_inventory()
+            if self.revalidate:
+                self.start_revalidation()
 
         # Data to print
         if self.args.host:
             data_to_print = self.get_host_info(self.args.host)
+        elif self.args.query:
+            data_to_print = self.query_servers(self.args.query)
+        elif self.args.report:
+            data_to_print = fleet_report(self.inventory)
+            if self.args.report_format == 'csv':
+                write_csv(data_to_print, sys.stdout)
+                return
         elif self.args.list:
             # Display list of nodes for inventory
             data_to_print = {
                 _group: [server['label'] for server
                          in self.inventory if server['label']],
                 '_meta': {
-                    'hostvars': dict((server['label'],
-                                      self.get_host_info(label=server['label']))
-                                     for server in self.inventory)
+                    'hostvars': dict((label, self.get_host_vars(server))
+                                     for (label, server) in self.servers_by_label.items())
                 }
             }
+            for (account, servers) in self.account_inventory.items():
+                data_to_print["%s_%s" % (_group, account)] = [server['label'] for server in servers
+                                                              if server['label']]
         else:
             data_to_print = "Error: Invalid options"
 
-        print(json_format_dict(data_to_print, True))
+        print(json_format_dict(data_to_print, not self.hostvars_minimal))
+
+    def store_is_complete(self):
+        """Whether the store holds servers for every account (of any age)."""
+        return self.store is not None and not self.args.refresh_cache and \
+            all(self.store.age(name) is not None for (name, api_user, api_key) in self.accounts)
 
     def update_inventory(self):
-        """Makes a CloudAtCost API call to get the list of servers."""
-        res = self.api.get_server_info()
-        if res['status'] == 'ok':
-            self.inventory = res['data']
+        """Get the list of servers for every account, with one concurrent CloudAtCost API call per stale account."""
+        results = {}
+        stale = []
+        for account in self.accounts:
+            servers = self.get_cached_servers(account[0])
+            if servers is None:
+                stale.append(account)
+            else:
+                results[account[0]] = servers
+
+        if stale:
+            pool = ThreadPool(len(stale))
+            try:
+                fetched = pool.map(self.get_account_servers, stale)
+            except Exception, e:
+                print("Looks like CloudAtCost's API is down:")
+                print("")
+                print(e)
+                sys.exit(1)
+            finally:
+                pool.close()
+
+            for ((account, api_user, api_key), servers) in zip(stale, fetched):
+                self.cache_servers(account, servers)
+                results[account] = servers
+
+        self.inventory = []
+        self.servers_by_label = {}
+        for (account, api_user, api_key) in self.accounts:
+            self.account_inventory[account] = results[account]
+            self.inventory.extend(results[account])
+
+        # Index by label, so host lookups don't rescan the whole fleet.  The
+        # first server with a given label wins, as with a linear search.
+        for server in self.inventory:
+            self.servers_by_label.setdefault(server['label'], server)
+
+    def get_cached_servers(self, name):
+        """
+        Get the list of servers for one account from the store or cache, if it is fresh enough.
+
+        A cache that is older than cache_max_age, but within stale_while_revalidate of it, is still returned, and
+        flagged for a background refresh.
+        """
+        if not self.cache_max_age or self.args.refresh_cache:
+            return None
+
+        cache_file = self.cache_file(name)
+        if self.store is not None:
+            age = self.store.age(name)
+        elif os.path.isfile(cache_file):
+            age = time() - os.path.getmtime(cache_file)
         else:
-            print("Looks like CloudAtCost's API is down:")
-            print("")
-            print(res)
-            sys.exit(1)
+            age = None
+
+        if age is None or age >= self.cache_max_age + self.stale_while_revalidate:
+            return None
+        if age >= self.cache_max_age:
+            self.revalidate = True
+
+        if self.store is not None:
+            return self.store.servers(name)
+        with open(cache_file) as f:
+            return json.load(f)
+
+    def refresh_lock(self):
+        """Open the lock file held by a background refresh."""
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+        return open(os.path.join(self.cache_path, 'ansible-cloudatcost-refresh.lock'), 'a')
+
+    def start_revalidation(self):
+        """Start a detached refresh of the cache, unless one is already running."""
+        with self.refresh_lock() as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen([sys.executable, os.path.realpath(__file__), '--list', '--revalidate'],
+                             stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+    def refresh_in_background(self):
+        """
+        Refresh the cache of every account older than cache_max_age, unless another refresh holds the lock.
+
+        Another refresh may have finished between this one being started and taking the lock, so the age of each
+        account is checked again under it, and only the stale ones are fetched.
+        """
+        with self.refresh_lock() as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            self.stale_while_revalidate = 0
+            self.update_inventory()
+
+    def cache_servers(self, name, servers):
+        """Save the list of servers for one account to the store or cache."""
+        if self.store is not None:
+            self.store.refresh(name, servers)
+        elif self.cache_max_age:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path, 0o700)
+            # The records hold root passwords, so only the current user may read them.  The cache is replaced in one
+            # rename, so a concurrent reader never sees a partly written file.
+            (fd, tmp_path) = tempfile.mkstemp(prefix='.ansible-cloudatcost-%s.' % name, dir=self.cache_path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(servers, f)
+            os.rename(tmp_path, self.cache_file(name))
+
+    def cache_file(self, name):
+        return os.path.join(self.cache_path, 'ansible-cloudatcost-%s.cache' % name)
+
+    def get_account_servers(self, account):
+        """Get the list of servers for one account from the CloudAtCost API."""
+        (name, api_user, api_key) = account
+
+        # Stream the servers, only keeping the configured fields.
+        res = {}
+        servers = list(iter_server_info(self.get_api(api_user, api_key), self.fields, res))
+        if res.get('status') != 'ok':
+            raise Exception("Account %s: %s" % (name, res))
+
+        for server in servers:
+            server['account'] = name
+        return servers
 
     def get_server(self, server_id=None, label=None):
         """Gets details about a specific server."""
+        if label and not server_id:
+            if self.store is not None:
+                return self.store.get(label)
+            return self.servers_by_label.get(label)
         for server in self.inventory:
             if (server_id and server['id'] == server_id) or \
                     (label and server['label'] == label):
                 return server
         return None
 
+    def query_servers(self, query):
+        """Get the servers matching a query of comma-separated field=value criteria."""
+        try:
+            criteria = dict(criterion.split('=', 1) for criterion in query.split(',') if criterion)
+        except ValueError:
+            print("Invalid query: %s.  Use field=value[,field=value...]" % query)
+            sys.exit(1)
+
+        if self.store is not None:
+            try:
+                return self.store.query(**criteria)
+            except KeyError, e:
+                print(e.args[0])
+                sys.exit(1)
+        return [server for server in self.inventory
+                if all(str(server.get(field)) == value for (field, value) in criteria.items())]
+
     def get_host_info(self, label):
         """Get variables about a specific host."""
 
@@ -84,44 +309,82 @@ class CloudAtCostInventory(object):
         if not server:
             return json_format_dict({}, True)
 
+        return self.get_host_vars(server)
+
+    def get_host_vars(self, server):
+        """Build the hostvars for a server record, with only the configured fields."""
         retval = {}
         for (key, value) in server.iteritems():
-            retval["{}{}".format(_prepend, key)] = value
+            if (self.hostvars_include is None or key in self.hostvars_include) and \
+                    key not in self.hostvars_exclude:
+                retval["{}{}".format(_prepend, key)] = value
 
         # Set the SSH host information, so these inventory items can be used if
         # their labels aren't FQDNs
-        retval['ansible_ssh_host'] = server["ip"]
+        if not self.hostvars_minimal:
+            retval['ansible_ssh_host'] = server["ip"]
         retval['ansible_host'] = server["ip"]
 
         return retval
 
-    def setupAPI(self):
+    def read_settings(self):
+        """Read the accounts and cache settings from cac_inv.ini, falling back to the environment."""
+        config_path = os.environ.get('CAC_INI_PATH',
+                                     os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cac_inv.ini'))
+        config = ConfigParser.SafeConfigParser()
+        config.read(config_path)
 
-        # Setup the api_key
-        if not self.api_key:
+        if config.has_option('defaults', 'cache_path'):
+            self.cache_path = os.path.expanduser(config.get('defaults', 'cache_path'))
+        if config.has_option('defaults', 'cache_max_age'):
+            self.cache_max_age = config.getint('defaults', 'cache_max_age')
+        if config.has_option('defaults', 'stale_while_revalidate'):
+            self.stale_while_revalidate = config.getint('defaults', 'stale_while_revalidate')
+        if config.has_option('defaults', 'store_path'):
+            store_path = os.path.expanduser(config.get('defaults', 'store_path'))
+            if not os.path.isdir(os.path.dirname(store_path)):
+                os.makedirs(os.path.dirname(store_path), 0o700)
+            self.store = FleetStore(store_path)
+        if config.has_option('defaults', 'fields'):
+            # ip and label are always needed to build the inventory
+            self.fields = set(f.strip() for f in config.get('defaults', 'fields').split(',')) | set(['ip', 'label'])
+        if config.has_option('defaults', 'hostvars_include'):
+            self.hostvars_include = set(f.strip() for f in config.get('defaults', 'hostvars_include').split(','))
+        if config.has_option('defaults', 'hostvars_exclude'):
+            self.hostvars_exclude = set(f.strip() for f in config.get('defaults', 'hostvars_exclude').split(','))
+        if config.has_option('defaults', 'hostvars_minimal'):
+            self.hostvars_minimal = config.getboolean('defaults', 'hostvars_minimal')
+            if self.hostvars_minimal:
+                self.hostvars_include = set(_minimal_hostvars)
+
+        for section in config.sections():
+            if section.startswith('account:'):
+                self.accounts.append((section[len('account:'):], config.get(section, 'api_user'),
+                                      config.get(section, 'api_key')))
+
+        if not self.accounts:
+            # Setup the api_key
             try:
-                self.api_key = os.environ['CAC_API_KEY']
+                api_key = os.environ['CAC_API_KEY']
             except KeyError, e:
                 print "Please provide API Key."
                 sys.exit(1)
 
-        # Setup the api_user
-        if not self.api_user:
+            # Setup the api_user
             try:
-                self.api_user = os.environ['CAC_API_USER']
+                api_user = os.environ['CAC_API_USER']
             except KeyError, e:
                 print "Please provide API User."
                 sys.exit(1)
 
-        # setup the auth
-        try:
-            self.api = CACPy(self.api_user, self.api_key)
-            self.api.get_resources()
-        except Exception, e:
-            print "Failed to contact CloudAtCost API."
-            print ""
-            print e
-            sys.exit(1)
+            self.accounts.append(('default', api_user, api_key))
+
+    @staticmethod
+    def get_api(api_user, api_key):
+        if os.environ.get('CAC_CASSETTE'):
+            from cloudatcost_ansible_module.cassette import cassette_api
+            return cassette_api(api_user, api_key)
+        return CACPy(api_user, api_key)
 
     @staticmethod
     def parse_cli_args():
@@ -133,10 +396,17 @@ class CloudAtCostInventory(object):
                            help='List servers (default: True)')
         group.add_argument('--host', action='store',
                            help='Get all the variables about a specific server')
+        group.add_argument('--query', action='store',
+                           help='List the servers matching field=value[,field=value...] (ie. status=Installing)')
+        group.add_argument('--report', action='store_true',
+                           help='Report utilization, over- and under-provisioned servers, and totals')
+        parser.add_argument('--report-format', choices=['json', 'csv'], default='json',
+                            help='Format of --report (default: json)')
 
         parser.add_argument('--refresh-cache', action='store_true',
                             default=False,
                             help='Force refresh of cache by making API requests to CloudAtCost (default: False - use cache files)')
+        parser.add_argument('--revalidate', action='store_true', default=False, help=argparse.SUPPRESS)
         return parser.parse_args()
 
 
@@ -150,4 +420,5 @@ def json_format_dict(data, pretty=False):
         return json.dumps(data)
 
 
-CloudAtCostInventory()
+if __name__ == '__main__':
+    CloudAtCostInventory()
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# Custom Module to gather facts about all servers in a CloudAtCost
+# (https://cloudatcost.com) account in one API call
+from ansible.module_utils.basic import *
+
+DOCUMENTATION = '''
+---
+module: cac_facts
+author: "Patrick Toal (@sage905)"
+short_description: Gather facts about every server in a CloudAtCost account
+description: >
+    Fetch the server list from the CloudAtCost API once, and return facts for
+    every server, keyed by label and (optionally) by inventory hostname.
+    Run it once per play, rather than running cac_server for each host.
+
+options:
+  api_key:
+    description:
+     - CloudAtCost API key
+    default: null
+  api_user:
+    description:
+     - CloudAtCost API Username
+    default: null
+  hosts:
+    description:
+     - Mapping of inventory hostname to address (ie. ansible_host).  Each host
+       is matched to the server whose I(ip) is that address, or failing that,
+       whose label is the inventory hostname.
+    default: null
+    type: dict
+requirements:
+    - "python >= 2.6"
+    - "cacpy >= 0.5.3"
+notes:
+  - CAC_API_KEY and CAC_API_USER environment variables can be used instead
+    of I(api_key) and I(api_user)
+'''
+
+EXAMPLES = '''
+---
+# Gather facts for every host in the play, with one API call
+- cac_facts:
+    hosts: "{% set m = {} %}{% for h in ansible_play_hosts %}{% set _ = m.update({h: hostvars[h].ansible_host | default(h)}) %}{% endfor %}{{ m }}"
+  delegate_to: localhost
+  run_once: yes
+  register: cac_fleet
+
+- set_fact:
+    cac_server: "{{ cac_fleet.ansible_facts.cac_hosts[inventory_hostname] }}"
+  when: inventory_hostname in cac_fleet.ansible_facts.cac_hosts
+
+# Look up a server by label
+- debug:
+    msg: "{{ cac_servers['web1'].ip }}"
+'''
+
+RETURN = '''
+cac_servers:
+    description: Facts for every server in the account, keyed by label
+    returned: success
+    type: dict
+cac_hosts:
+    description: Facts for each matched host in I(hosts), keyed by inventory hostname
+    returned: success
+    type: dict
+cac_unmatched_hosts:
+    description: Hosts in I(hosts) that matched no server
+    returned: success
+    type: list
+'''
+
+ANSIBLE_METADATA = {'status': ['preview'],
+                    'supported_by': 'community',
+                    'version': '1.0'}
+
+try:
+    from cloudatcost_ansible_module import cac_server
+
+    HAS_CAC_MODULE = True
+    HAS_CAC = cac_server.HAS_CAC
+except ImportError:
+    HAS_CAC_MODULE = False
+    HAS_CAC = False
+
+
+def server_facts(server):
+    """ Return the facts for a CACServer as a plain dict. """
+    facts = dict(server)
+    if server['template'] is not None:
+        facts['template'] = server['template'].desc
+        facts['template_id'] = server['template'].template_id
+    return facts
+
+
+def gather_facts(servers, hosts=None):
+    """
+    Build the fact maps for a list of CACServers.
+
+    :param servers: CACServers from a single snapshot
+    :param hosts: dict of inventory hostname to address
+    :return: (facts by label, facts by inventory hostname, list of unmatched hostnames)
+    """
+    by_label = {}
+    by_ip = {}
+    for server in servers:
+        facts = server_facts(server)
+        # First server with a label wins, as with get_server
+        if facts.get('label'):
+            by_label.setdefault(facts['label'], facts)
+        by_ip.setdefault(facts.get('ip'), facts)
+
+    by_host = {}
+    unmatched = []
+    for (hostname, address) in (hosts or {}).items():
+        facts = by_ip.get(address) or by_label.get(hostname)
+        if facts:
+            by_host[hostname] = facts
+        else:
+            unmatched.append(hostname)
+
+    return by_label, by_host, sorted(unmatched)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            api_key=dict(type='str', no_log=True),
+            api_user=dict(type='str'),
+            hosts=dict(type='dict'),
+        ),
+        supports_check_mode=True
+    )
+
+    if not HAS_CAC_MODULE:
+        module.fail_json(msg='cloudatcost_ansible_module package required for this module')
+    if not HAS_CAC:
+        module.fail_json(msg='CACPy required for this module')
+
+    try:
+        api = cac_server.get_api(module.params.get('api_user'), module.params.get('api_key'), check=False)
+        servers = [cac_server.CACServer(api, server) for server in cac_server.prefetch(api, check=False)]
+        by_label, by_host, unmatched = gather_facts(servers, module.params.get('hosts'))
+    except Exception as e:
+        module.fail_json(msg='%s' % e)
+
+    module.exit_json(changed=False, ansible_facts=dict(cac_servers=by_label, cac_hosts=by_host,
+                                                       cac_unmatched_hosts=unmatched))
+
+
+if __name__ == '__main__':
+    main()
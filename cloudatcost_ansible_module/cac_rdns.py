@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# Custom Module to reconcile reverse DNS for many servers in a CloudAtCost
+# (https://cloudatcost.com) account at once
+from multiprocessing.pool import ThreadPool
+import re
+
+from ansible.module_utils.basic import *
+
+DOCUMENTATION = '''
+---
+module: cac_rdns
+author: "Patrick Toal (@sage905)"
+short_description: Set reverse DNS for many CloudAtCost servers at once
+description: >
+    Compare the desired reverse DNS names with the rdns of every server, from a
+    single listservers call, and change only the ones that differ.  Changes
+    are made concurrently.
+
+options:
+  api_key:
+    description:
+     - CloudAtCost API key
+    default: null
+  api_user:
+    description:
+     - CloudAtCost API Username
+    default: null
+  names:
+    description:
+     - Mapping of server label or IP address to Fully Qualified Domain-Name
+    default: null
+    type: dict
+  zone_file:
+    description:
+     - Path to a zone-style file of names to set: either a BIND zone file, or
+       lines of C(<label or ip> <fqdn>).  Names come from the A records
+       (C(<fqdn> IN A <ip>)) and PTR records (C(<d> IN PTR <fqdn>)), and the
+       other records and directives are skipped.  C($ORIGIN), multi-line
+       records in parentheses, C(@) and relative names are handled.  Comments
+       start with C(;) or C(#).
+    default: null
+    type: path
+  origin:
+    description:
+     - Origin of the names in I(zone_file) until its first C($ORIGIN), ie.
+       the zone name from named.conf (C(1.1.10.in-addr.arpa))
+    default: null
+    type: string
+  parallelism:
+    description:
+     - Maximum number of changes to make at the same time
+    default: 4
+    type: integer
+requirements:
+    - "python >= 2.6"
+    - "cacpy >= 0.5.3"
+notes:
+  - One of I(names) or I(zone_file) is required.
+  - Entries that match no server are returned in I(unmatched), and are
+    otherwise ignored.
+  - CAC_API_KEY and CAC_API_USER environment variables can be used instead
+    of I(api_key) and I(api_user)
+'''
+
+EXAMPLES = '''
+---
+- local_action:
+     module: cac_rdns
+     names:
+       web1: web1.example.com
+       10.1.1.3: db1.example.com
+
+- local_action:
+     module: cac_rdns
+     zone_file: /etc/bind/db.10.1.1
+     origin: 1.1.10.in-addr.arpa
+     parallelism: 8
+'''
+
+RETURN = '''
+changes:
+    description: The rdns changes made (or that would be made, in check mode), keyed by server id
+    returned: success
+    type: dict
+    sample: {"254123456": {"label": "web1", "before": "notassigned.cloudatcost.com", "after": "web1.example.com"}}
+errors:
+    description: The error of each change that failed, keyed by server id
+    returned: failure
+    type: dict
+unmatched:
+    description: Labels or addresses that matched no server
+    returned: success
+    type: list
+'''
+
+ANSIBLE_METADATA = {'status': ['preview'],
+                    'supported_by': 'community',
+                    'version': '1.0'}
+
+try:
+    from cloudatcost_ansible_module import cac_server
+
+    HAS_CAC_MODULE = True
+    HAS_CAC = cac_server.HAS_CAC
+except ImportError:
+    HAS_CAC_MODULE = False
+    HAS_CAC = False
+
+
+# The only listservers fields needed to reconcile rdns.
+RDNS_FIELDS = ('sid', 'label', 'ip', 'rdns')
+
+_TTL = re.compile(r'^(\d+[smhdw]?)+$', re.IGNORECASE)
+_CLASSES = ('IN', 'CH', 'HS', 'CS')
+_REVERSE_ZONE = '.in-addr.arpa'
+
+
+def _absolute(name, origin):
+    """ Return a zone file name as an FQDN without the trailing dot, relative names being under origin """
+    if name == '@':
+        name = origin + '.' if origin else name
+    if name.endswith('.'):
+        return name[:-1]
+    return '%s.%s' % (name, origin) if origin else name
+
+
+def _records(lines):
+    """ Yield the tokens of each entry of a zone file, without comments, and joining multi-line entries """
+    entry = []
+    depth = 0
+    for line in lines:
+        line = line.split(';')[0].split('#')[0]
+        if not entry and line[:1] in (' ', '\t'):
+            # No owner: the entry is for the previous one
+            entry.append(None)
+        depth += line.count('(') - line.count(')')
+        entry.extend(line.replace('(', ' ').replace(')', ' ').split())
+        if depth <= 0:
+            if [token for token in entry if token is not None]:
+                yield entry
+            entry = []
+            depth = 0
+    if entry and depth > 0:
+        raise ValueError("Unbalanced parentheses at the end of the zone file")
+
+
+def parse_zone(lines, origin=None):
+    """
+    Parse a zone file into a mapping of label or IP to FQDN.
+
+    The names come from A and PTR records, and from lines of just <label or ip> <fqdn>.  Other records, $TTL and
+    unknown directives are skipped.  Relative names are under $ORIGIN, or the origin given until the first $ORIGIN.
+
+    :raises ValueError if a PTR record isn't for an IPv4 address, or a line can't be parsed
+    """
+    origin = origin.rstrip('.') if origin else None
+    names = {}
+    owner = None
+    for tokens in _records(lines):
+        if tokens[0] is not None and tokens[0].startswith('$'):
+            if tokens[0].upper() == '$ORIGIN' and len(tokens) == 2:
+                origin = _absolute(tokens[1], origin)
+            elif tokens[0].upper() == '$INCLUDE':
+                raise ValueError("$INCLUDE isn't supported in zone files: %s" % ' '.join(tokens))
+            continue
+
+        if tokens[0] is not None:
+            owner = tokens[0]
+        rest = tokens[1:]
+        if len(rest) == 1 and tokens[0] is not None:
+            # <label or ip> <fqdn>
+            names[owner] = rest[0].rstrip('.')
+            continue
+        while rest and (_TTL.match(rest[0]) or rest[0].upper() in _CLASSES):
+            rest = rest[1:]
+        if owner is None or len(rest) < 2:
+            raise ValueError("Unable to parse zone entry: %s" % ' '.join(t for t in tokens if t is not None))
+
+        rtype = rest[0].upper()
+        if rtype == 'A':
+            names[rest[1]] = _absolute(owner, origin)
+        elif rtype == 'PTR':
+            name = _absolute(owner, origin)
+            octets = name[:-len(_REVERSE_ZONE)].split('.') if name.lower().endswith(_REVERSE_ZONE) else []
+            if len(octets) != 4 or not all(octet.isdigit() for octet in octets):
+                raise ValueError("PTR record for %s isn't for an IPv4 address.  Set $ORIGIN or origin for relative "
+                                 "names." % name)
+            names['.'.join(reversed(octets))] = _absolute(rest[1], origin)
+    return names
+
+
+def plan_changes(servers, names):
+    """
+    Match names to servers, and set rdns on the ones that differ.
+
+    :param servers: CACServers from a single snapshot
+    :param names: dict of label or IP to FQDN
+    :return: (list of CACServers with a pending rdns change, list of unmatched names)
+    """
+    by_label = {}
+    by_ip = {}
+    for server in servers:
+        by_label.setdefault(server['label'], server)
+        by_ip.setdefault(server['ip'], server)
+
+    changed = {}
+    unmatched = []
+    for (key, fqdn) in names.items():
+        server = by_label.get(key) or by_ip.get(key)
+        if server is None:
+            unmatched.append(key)
+            continue
+        server['rdns'] = fqdn
+        if server.check():
+            changed[server['sid']] = server
+    return list(changed.values()), sorted(unmatched)
+
+
+def apply_changes(servers, parallelism=4):
+    """
+    Apply the pending changes of each server, at most parallelism at a time.
+
+    :return: dict of server id to error message, for the servers that failed
+    """
+    def apply(server):
+        try:
+            server.apply_changes()
+        except Exception as e:
+            return server['sid'], '%s' % e
+
+    pool = ThreadPool(max(1, min(parallelism, len(servers))))
+    try:
+        return dict(failure for failure in pool.map(apply, servers) if failure)
+    finally:
+        pool.close()
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            api_key=dict(type='str', no_log=True),
+            api_user=dict(type='str'),
+            names=dict(type='dict'),
+            zone_file=dict(type='path'),
+            origin=dict(type='str'),
+            parallelism=dict(type='int', default=4),
+        ),
+        mutually_exclusive=[['names', 'zone_file']],
+        required_one_of=[['names', 'zone_file']],
+        supports_check_mode=True
+    )
+
+    if not HAS_CAC_MODULE:
+        module.fail_json(msg='cloudatcost_ansible_module package required for this module')
+    if not HAS_CAC:
+        module.fail_json(msg='CACPy required for this module')
+
+    try:
+        names = module.params.get('names')
+        if module.params.get('zone_file'):
+            with open(module.params.get('zone_file')) as f:
+                names = parse_zone(f, module.params.get('origin'))
+
+        api = cac_server.get_api(module.params.get('api_user'), module.params.get('api_key'), check=False)
+        servers = [cac_server.CACServer(api, server)
+                   for server in cac_server.prefetch(api, templates=False, fields=RDNS_FIELDS, check=False)]
+        servers, unmatched = plan_changes(servers, names)
+        # Keyed by sid: labels can be empty or shared
+        changes = dict((server['sid'], dict(label=server['label'], before=server.__getstate__()['rdns'],
+                                            after=server['rdns']))
+                       for server in servers)
+
+        failed = {}
+        if not module.check_mode and servers:
+            failed = apply_changes(servers, module.params.get('parallelism'))
+    except Exception as e:
+        module.fail_json(msg='%s' % e)
+
+    if failed:
+        module.fail_json(msg="Failed to set rdns for: %s" % ", ".join(
+            "%s (%s)" % (changes[sid]['label'], sid) for sid in sorted(failed)), errors=failed,
+                         changes=changes, unmatched=unmatched)
+    module.exit_json(changed=bool(changes), changes=changes, unmatched=unmatched)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+# Custom Module to restart a group of servers in a CloudAtCost
+# (https://cloudatcost.com) account, one batch at a time
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+import socket
+import threading
+import time
+
+from ansible.module_utils.basic import *
+
+DOCUMENTATION = '''
+---
+module: cac_rolling_restart
+author: "Patrick Toal (@sage905)"
+short_description: Restart a group of CloudAtCost servers, a batch at a time
+description: >
+    Select servers from a single listservers call, and restart them in
+    batches.  The servers of a batch are restarted concurrently, and the next
+    batch starts once every server in the batch is Powered On again (and,
+    optionally, accepting TCP connections).  One status watcher polls
+    listservers for all waiting servers.
+
+options:
+  api_key:
+    description:
+     - CloudAtCost API key
+    default: null
+  api_user:
+    description:
+     - CloudAtCost API Username
+    default: null
+  selector:
+    description:
+     - Mapping of listservers field to a shell-style pattern.  Servers whose
+       fields match every pattern are restarted, in listservers order.
+    required: true
+    type: dict
+  batch_size:
+    description:
+     - Number of servers to restart at the same time
+    default: 1
+    type: integer
+  max_unavailable:
+    description:
+     - Number of servers (ie. C(2)), or percentage of the selected servers
+       (ie. C(25%)), that may be restarting at the same time.  An alternative
+       to I(batch_size).
+    default: null
+    type: string
+  health_check_port:
+    description:
+     - TCP port that must accept connections on each server's IP before its
+       batch is done
+    default: null
+    type: integer
+  health_check_timeout:
+    description:
+     - How long to wait for I(health_check_port), in seconds
+    default: 300
+    type: integer
+  wait_timeout:
+    description:
+     - How long to wait for each server to be Powered On again, in seconds
+    default: 900
+    type: integer
+  poll_interval:
+    description:
+     - Seconds between listservers polls while servers are restarting.  The
+       interval grows while nothing changes.
+    default: 5
+    type: float
+requirements:
+    - "python >= 2.6"
+    - "cacpy >= 0.5.3"
+notes:
+  - I(batch_size) and I(max_unavailable) are mutually exclusive.
+  - If any server in a batch fails to restart or come back, no further
+    batches are restarted.
+  - CAC_API_KEY and CAC_API_USER environment variables can be used instead
+    of I(api_key) and I(api_user)
+'''
+
+EXAMPLES = '''
+---
+# Restart the web servers two at a time, waiting for HTTP to come back
+- local_action:
+     module: cac_rolling_restart
+     selector:
+       label: "web*"
+       status: Powered On
+     batch_size: 2
+     health_check_port: 80
+
+# Restart a quarter of the cluster at a time
+- local_action:
+     module: cac_rolling_restart
+     selector:
+       label: "db-*"
+     max_unavailable: 25%
+'''
+
+RETURN = '''
+batches:
+    description: Each batch, in order, with the labels of its servers, the seconds it took, and the label and error of
+                 each server that failed, keyed by sid (labels can be empty or shared).  In check mode, only the
+                 labels.
+    returned: always
+    type: list
+    sample: [{"servers": ["web1", "web2"], "seconds": 94.2,
+              "failed": {"123456789": {"label": "web2", "error": "Not Powered On after 900s"}}}]
+'''
+
+ANSIBLE_METADATA = {'status': ['preview'],
+                    'supported_by': 'community',
+                    'version': '1.0'}
+
+try:
+    from cloudatcost_ansible_module import cac_server
+    from cloudatcost_ansible_module.status_broker import StatusBroker
+    from cloudatcost_ansible_module.stream import project
+
+    HAS_CAC_MODULE = True
+    HAS_CAC = cac_server.HAS_CAC
+except ImportError:
+    HAS_CAC_MODULE = False
+    HAS_CAC = False
+
+
+# The only listservers fields a CACServer needs to restart a server.
+RESTART_FIELDS = ('sid', 'label', 'status')
+
+
+def select_servers(servers, selector):
+    """ Return the server records whose fields match every shell-style pattern in selector """
+    return [server for server in servers
+            if all(fnmatch('%s' % server.get(field, ''), '%s' % pattern) for (field, pattern) in selector.items())]
+
+
+def get_batch_size(count, batch_size=None, max_unavailable=None):
+    """
+    Return the number of servers per batch: batch_size, or max_unavailable as a number or a percentage (ie. '25%')
+    of count.  Always at least 1.
+    """
+    if max_unavailable is not None:
+        max_unavailable = ('%s' % max_unavailable).strip()
+        if max_unavailable.endswith('%'):
+            return max(1, int(count * float(max_unavailable[:-1]) / 100))
+        return max(1, int(max_unavailable))
+    return max(1, batch_size or 1)
+
+
+def batches(servers, size):
+    return [servers[i:i + size] for i in range(0, len(servers), size)]
+
+
+def wait_for_port(host, port, timeout, interval=2):
+    """ Return True once host accepts a TCP connection on port, or False after timeout seconds. """
+    expires = time.time() + timeout
+    while True:
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return False
+        try:
+            socket.create_connection((host, port), min(remaining, 5)).close()
+            return True
+        except socket.error:
+            time.sleep(max(0, min(interval, expires - time.time())))
+
+
+def restart_server(api, watcher, record, wait_timeout, health_check_port=None, health_check_timeout=300):
+    """
+    Restart a server, and wait until the watcher sees it Powered On again, and health_check_port (if any) accepts
+    connections.  As with cac_server, the server must first be seen to leave Powered On, within RESTART_GRACE seconds.
+
+    :return: an error message, or None if the server is back
+    """
+    server = cac_server.CACServer(api, project(record, RESTART_FIELDS))
+    server['status'] = 'Restarted'
+    restarted = time.time()
+    try:
+        server.apply_changes()
+    except Exception as e:
+        return 'Restart failed: %s' % e
+
+    watcher.wait_for_status('Powered On', sid=record['sid'], timeout=min(cac_server.RESTART_GRACE, wait_timeout),
+                            since=restarted, leave=True)
+    remaining = max(0, wait_timeout - (time.time() - restarted))
+    if watcher.wait_for_status('Powered On', sid=record['sid'], timeout=remaining, since=restarted) is None:
+        return 'Not Powered On after %ss' % wait_timeout
+    if health_check_port and not wait_for_port(record['ip'], health_check_port, health_check_timeout):
+        return 'Port %s not accepting connections after %ss' % (health_check_port, health_check_timeout)
+
+
+def rolling_restart(api, watcher, servers, size, wait_timeout=900, health_check_port=None, health_check_timeout=300):
+    """
+    Restart servers, size at a time.  Stops after the first batch with a failure.
+
+    :param watcher: running StatusBroker for the account
+    :return: list of dicts with the labels, seconds taken and failures (sid: dict of label and error) of each batch
+             restarted
+    """
+    def restart(record):
+        return restart_server(api, watcher, record, wait_timeout, health_check_port, health_check_timeout)
+
+    results = []
+    for batch in batches(servers, size):
+        start = time.time()
+        pool = ThreadPool(len(batch))
+        try:
+            errors = pool.map(restart, batch)
+        finally:
+            pool.close()
+        # Keyed by sid: labels can be empty or shared
+        failed = dict((record['sid'], dict(label=record['label'], error=error))
+                      for (record, error) in zip(batch, errors) if error)
+        results.append(dict(servers=[record['label'] for record in batch], seconds=round(time.time() - start, 3),
+                            failed=failed))
+        if failed:
+            break
+    return results
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            api_key=dict(type='str', no_log=True),
+            api_user=dict(type='str'),
+            selector=dict(type='dict', required=True),
+            batch_size=dict(type='int'),
+            max_unavailable=dict(type='str'),
+            health_check_port=dict(type='int'),
+            health_check_timeout=dict(type='int', default=300),
+            wait_timeout=dict(type='int', default=900),
+            poll_interval=dict(type='float', default=5),
+        ),
+        mutually_exclusive=[['batch_size', 'max_unavailable']],
+        supports_check_mode=True
+    )
+
+    if not HAS_CAC_MODULE:
+        module.fail_json(msg='cloudatcost_ansible_module package required for this module')
+    if not HAS_CAC:
+        module.fail_json(msg='CACPy required for this module')
+
+    try:
+        api = cac_server.get_api(module.params.get('api_user'), module.params.get('api_key'), check=False)
+        servers = select_servers(cac_server.prefetch(api, templates=False, check=False), module.params.get('selector'))
+        size = get_batch_size(len(servers), module.params.get('batch_size'), module.params.get('max_unavailable'))
+
+        if module.check_mode or not servers:
+            module.exit_json(changed=bool(servers), batches=[dict(servers=[record['label'] for record in batch])
+                                                             for batch in batches(servers, size)])
+
+        interval = module.params.get('poll_interval')
+        watcher = StatusBroker(api, min_interval=interval, max_interval=max(interval, 30))
+        poller = threading.Thread(target=watcher.run)
+        poller.daemon = True
+        poller.start()
+        try:
+            results = rolling_restart(api, watcher, servers, size, module.params.get('wait_timeout'),
+                                      module.params.get('health_check_port'),
+                                      module.params.get('health_check_timeout'))
+        finally:
+            watcher.stop()
+    except Exception as e:
+        module.fail_json(msg='%s' % e)
+
+    if results[-1]['failed']:
+        module.fail_json(msg="Rolling restart stopped after batch %d.  Failed: %s" % (
+            len(results), ", ".join("%s (%s): %s" % (failure['label'], sid, failure['error'])
+                                    for (sid, failure) in sorted(results[-1]['failed'].items()))),
+            changed=True, batches=results)
+    module.exit_json(changed=True, batches=results)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 # Custom Module to manage server instances in a CloudAtCost
 # (https://cloudatcost.com) Cloud
 from collections import namedtuple, defaultdict, MutableMapping
+from multiprocessing.pool import ThreadPool
 import string
 
 from ansible.module_utils.basic import *
@@ -78,7 +79,11 @@ options:
     choices: ["safe", "normal"]
   wait:
     description:
-     - wait for the instance to be powered on before returning
+     - wait for a new instance to be powered on before returning.  With
+       C(state=started), C(stopped) or C(restarted), wait for the server to
+       reach that power state (C(Powered On) after a restart).  A restart is
+       only waited for once the server has been seen to leave C(Powered On);
+       if that isn't seen within 30 seconds, the server is taken to be back.
     default: "no"
     choices: [ "yes", "no" ]
   wait_timeout:
@@ -86,6 +91,14 @@ options:
      - how long before wait gives up, in seconds
     # 15min default.  When CloudAtCost is having problems, server provisioning can take DAYS.
     default: 900
+  timeout:
+    description:
+     - Deadline for the whole task, in seconds.  Every API request is given the
+       time remaining as its timeout, and waits end when it expires.  If the
+       deadline is exceeded, the task fails with the time spent in each phase.
+     - Defaults to I(wait_timeout) + 60
+    default: null
+    type: integer
 requirements:
     - "python >= 2.6"
     - "cacpy >= 0.5.3"
@@ -107,8 +120,20 @@ notes:
   - If C(state in ('absent', 'deleted')), the server will be destroyed!  Use
     with caution.
 
+  - If the server already matches, the returned I(server) is its
+    listservers record, read without listing templates, so its
+    I(template) is the template's name rather than its [name, id].
+
   - CAC_API_KEY and CAC_API_USER environment variables can be used instead
     of I(api_key) and I(api_user)
+
+  - Set CAC_STATUS_BROKER to the socket of a running status broker
+    (python -m cloudatcost_ansible_module.status_broker) to have I(wait)
+    block on it, rather than each task polling the API.
+
+  - Set CAC_CASSETTE (and optionally CAC_CASSETTE_MODE=record|replay and
+    CAC_CASSETTE_LATENCY) to record API exchanges to, or replay them from,
+    a cassette file instead of calling the API.
 '''
 
 EXAMPLES = '''
@@ -160,13 +185,15 @@ EXAMPLES = '''
      label: cloudatcost-test1
      state: stopped
 
-# Reboot a server
+# Reboot a server, and return once it is powered on again
 - local_action:
      module: cac_server
      api_user: bob@smith.com
      api_key: 'longStringFromCaCAPI'
      label: cloudatcost-test1
      state: restarted
+     wait: yes
+     wait_timeout: 600
 
 '''
 
@@ -182,37 +209,110 @@ except ImportError:
 
 try:
     from cacpy import CACPy
+    from cloudatcost_ansible_module.deadline import Deadline, DeadlineExceeded
+    from cloudatcost_ansible_module.stream import iter_server_info, TimeoutCACPy
 
     HAS_CAC = True
 except ImportError:
     HAS_CAC = False
 
 
+# listservers can go on showing Powered On for a while after a reset, so a restart is only waited for once the server
+# has been seen to leave Powered On.  If it isn't seen to within this many seconds (ie. the reset was too quick to
+# show), it is taken to be back.
+RESTART_GRACE = 30
+
+
 class CacApiError(Exception):
     """
     Raised when something went wrong during a call to CloudAtCost's API
     """
 
 
-def get_server(api, server_id=None, label=None, server_name=None):
+def get_server(api, server_id=None, label=None, server_name=None, fields=None, servers=None):
     """
     Use the CAC API to search for the provided server_id, servername, or label
     and return the first match found as a CACServer instance.
 
+    The server list is streamed, and reading stops at the first match.  If fields is given, only those fields
+    (and the ones needed to match) are kept.  If servers is given, those records (ie. from prefetch) are searched
+    instead of calling the API.
+
     Returns None if no server found.
     """
     assert server_id is not None or label is not None or server_name is not None
 
-    try:
-        server = next(
-            server for server in api.get_server_info().get('data') if
-            server['sid'] == str(server_id) or server['servername'] == server_name or server['label'] == label)
-    except StopIteration:
+    if fields is not None:
+        fields = set(fields) | set(['sid', 'servername', 'label'])
+
+    header = {}
+    if servers is None:
+        servers = iter_server_info(api, fields, header)
+    server = find_record(servers, server_id, label, server_name)
+    if server is None:
+        if header:
+            check_ok(header)
         return None
 
     return CACServer(api, server)
 
 
+def find_record(servers, server_id=None, label=None, server_name=None):
+    """ Return the first server record matching server_id, label or server_name, or None """
+    return next((server for server in servers if
+                 server['sid'] == str(server_id) or server['servername'] == server_name or server['label'] == label),
+                None)
+
+
+def list_servers(api, fields=None):
+    """ Return every server record from listservers, checking the response status """
+    header = {}
+    servers = list(iter_server_info(api, fields, header))
+    check_ok(header)
+    return servers
+
+
+def prefetch(api, templates=True, fields=None, check=True, server_id=None, label=None):
+    """
+    Make the reads every task starts with at the same time, rather than one after another: the credentials check
+    (get_resources, if check is set), listservers, and (optionally) listtemplates, which fills the CACTemplate cache.
+
+    If server_id or label is given, only that server is needed: listservers is streamed in this thread while the other
+    reads run, and reading stops at the first match, as with get_server.
+
+    :return: list of server records (only the matching one, or none, if server_id or label is given), for
+             get_server(servers=...)
+    """
+    def check_credentials():
+        check_ok(api.get_resources())
+
+    def list_templates():
+        CACTemplate.load(api)
+
+    def read_servers():
+        if server_id is None and label is None:
+            return list_servers(api, fields)
+        header = {}
+        server = find_record(iter_server_info(api, fields and set(fields) | set(['sid', 'servername', 'label']),
+                                              header), server_id, label)
+        if server is None:
+            check_ok(header)
+            return []
+        return [server]
+
+    reads = ([check_credentials] if check else []) + ([list_templates] if templates else [])
+    if not reads:
+        return read_servers()
+    pool = ThreadPool(len(reads))
+    try:
+        others = pool.map_async(lambda read: read(), reads)
+        servers = read_servers()
+        others.get()
+        return servers
+    finally:
+        pool.close()
+
+
 def check_ok(response):
     """ Verify that the API Call has an 'ok' status. """
     if response['status'] != 'ok':
@@ -226,6 +326,12 @@ class CACTemplate(namedtuple('CACTemplate', ['desc', 'template_id'])):
     # Cache templates as they aren't likely to change during execution.
     templates = {}
 
+    @classmethod
+    def load(cls, api):
+        """ Fill the template cache from the API, if it is empty """
+        if not cls.templates:
+            cls.templates = api.get_template_info()['data']
+
     @classmethod
     def get_template(cls, api, lookup=None):
         """Return a CACTemplate after querying the Cloudatcost API for a list of templates for a match.
@@ -244,8 +350,7 @@ class CACTemplate(namedtuple('CACTemplate', ['desc', 'template_id'])):
             lookup = lookup.template_id
         if isinstance(lookup, int):
             lookup = str(lookup)
-        if not cls.templates:
-            cls.templates = api.get_template_info()['data']
+        cls.load(api)
         try:
             template = next(t for t in cls.templates
                             if t.get('ce_id') == lookup or t.get('name') == lookup)
@@ -254,12 +359,52 @@ class CACTemplate(namedtuple('CACTemplate', ['desc', 'template_id'])):
         return cls(template.get('name'), template.get('ce_id'))
 
 
-def _poller(poll_func, waittime=300, interval=1):
-    for t in range(1, waittime, interval):
-        time.sleep(interval)
+def _poller(poll_func, waittime=300, interval=1, backoff=1, max_interval=None):
+    """
+    Call poll_func after each sleep until it returns a result, and return it.  Returns None once waittime seconds
+    have been slept.
+
+    The interval is multiplied by backoff after each poll, up to max_interval.
+    """
+    waited = 0
+    while waited < waittime:
+        sleep = min(interval, waittime - waited)
+        time.sleep(sleep)
+        waited += sleep
         result = poll_func()
         if result:
             return result
+        interval = min(interval * backoff, max_interval or interval * backoff)
+
+
+def wait_for_status(api, status, wait_timeout, servername=None, interval=10, deadline=None, server_id=None,
+                    backoff=1, max_interval=None, since=None, leave=False):
+    """
+    Wait for the server with the given servername or server_id to reach status (or, if leave is set, to have any other
+    status), and return it as a CACServer.  Returns None on timeout.
+
+    If CAC_STATUS_BROKER names the socket of a running status broker, wait on it rather than polling the API.
+    Otherwise listservers is polled every interval seconds, growing by backoff up to max_interval.  The wait ends
+    early if the deadline comes first.  since (ie. the time of a power change) keeps the broker from answering with a
+    status it saw before then; polls always happen after it.
+    """
+    if deadline is not None:
+        wait_timeout = int(min(wait_timeout, deadline.remaining()))
+
+    broker_socket = os.environ.get('CAC_STATUS_BROKER')
+    if broker_socket:
+        import socket
+        from cloudatcost_ansible_module import status_broker
+        try:
+            server = status_broker.wait_for_status(broker_socket, status, sid=server_id, servername=servername,
+                                                   timeout=wait_timeout, since=since, leave=leave)
+            return CACServer(api, server) if server else None
+        except socket.error:
+            # Broker isn't running.  Poll as usual.
+            pass
+
+    return _poller(CACServer.check_server_status(api, servername, status, server_id, leave), wait_timeout, interval,
+                   backoff, max_interval)
 
 
 class CACServer(MutableMapping):
@@ -289,12 +434,20 @@ class CACServer(MutableMapping):
 
     _modify_functions = {'label': _set_label, 'rdns': _set_rdns, 'status': _set_status, 'mode': _set_mode}
 
+    # Pending changes that must be made before a change to each attribute: power changes take effect under the new
+    # run mode.  A delete waits for every other change (see _depends_on).
+    _change_dependencies = {'status': ('mode',)}
+
+    # The status a server settles in after each status change, for commit(wait=True)
+    _settled_status = {'Powered On': 'Powered On', 'on': 'Powered On', 'Powered Off': 'Powered Off',
+                       'off': 'Powered Off', 'Restarted': 'Powered On', 'restart': 'Powered On'}
+
     def __init__(self, api, server):
         self.api = api
         self._current_state = dict(server)
         self._changed_attrs = dict()
 
-        if server['template'] is not None:
+        if server.get('template') is not None:
             self._current_state['template'] = CACTemplate.get_template(api, server['template'])
 
     def __delitem__(self, key):
@@ -332,7 +485,16 @@ class CACServer(MutableMapping):
     def check(self):
         return bool(self._changed_attrs)
 
-    def commit(self):
+    def commit(self, wait=False, wait_timeout=300, deadline=None):
+        """
+        Apply the pending changes, and return the server as it is afterwards.
+
+        If wait is set and the power status was changed, return once the server has settled in its new status
+        (Powered On after a restart), polling with a short, growing interval.  After a restart, the server must first
+        be seen to leave Powered On, within RESTART_GRACE seconds.
+
+        :raises CacApiError if the server doesn't settle within wait_timeout
+        """
         # Only commit existing records.
         if self['sid'] is None:
             raise AttributeError("Server commit failed. sid property not set on CACServer object.")
@@ -341,24 +503,90 @@ class CACServer(MutableMapping):
             raise LookupError("Unable to find server with sid: " + str(self['sid']))
 
         if len(self._changed_attrs) > 0:
-            for (item, value) in list(self._changed_attrs.items()):
-                self._modify_functions[item](self, value)
-
+            applied = time.time()
+            changes = self.apply_changes()
+            settled = self._settled_status.get(changes.get('status'))
+            if wait and settled:
+                if changes['status'] in ('Restarted', 'restart'):
+                    # Short, even polls, so a brief Restarting status isn't missed
+                    wait_for_status(self.api, 'Powered On', min(RESTART_GRACE, wait_timeout),
+                                    server_id=self['sid'], interval=2, deadline=deadline, since=applied, leave=True)
+                server = wait_for_status(self.api, settled, max(0, wait_timeout - (time.time() - applied)),
+                                         server_id=self['sid'], interval=2, deadline=deadline, backoff=1.5,
+                                         max_interval=10, since=applied)
+                if server is None:
+                    raise CacApiError("Server %s did not reach status %s within %ss" % (
+                        self['sid'], settled, wait_timeout))
+                return server
             return get_server(self.api, server_id=self['sid'])
         else:
             return self
 
+    def _depends_on(self, item, value):
+        if item == 'status' and value in ('Deleted', 'delete'):
+            return [other for other in self._modify_functions if other != item]
+        return self._change_dependencies.get(item, ())
+
+    def apply_changes(self):
+        """
+        Make the API calls for the pending changes, without looking the server up before or after.
+
+        Independent changes are made concurrently, so changing the label, rdns and run mode costs one API round-trip.
+        Changes that depend on others (_change_dependencies) are made once those have succeeded.
+
+        :return: dict of the attributes that were changed
+        :raises CacApiError naming every change that failed or was skipped
+        :raises DeadlineExceeded if a change ran out of time, once the changes made alongside it are done
+        """
+        changes = dict(self._changed_attrs)
+        pending = dict(changes)
+        errors = {}
+
+        def apply(item):
+            try:
+                self._modify_functions[item](self, pending[item])
+            except DeadlineExceeded:
+                # Not a failure of this change: the task is out of time, which the caller reports with its timings.
+                raise
+            except Exception as e:
+                return '%s' % e
+
+        while pending:
+            ready = [item for item in pending if not set(self._depends_on(item, pending[item])) & set(pending)]
+            if len(ready) == 1:
+                results = [apply(ready[0])]
+            else:
+                pool = ThreadPool(len(ready))
+                try:
+                    results = pool.map(apply, ready)
+                finally:
+                    pool.close()
+            for (item, error) in zip(ready, results):
+                if error:
+                    errors[item] = error
+                del pending[item]
+            for item in list(pending):
+                failed = set(self._depends_on(item, pending[item])) & set(errors)
+                if failed:
+                    errors[item] = 'Not changed, as the %s change failed' % ', '.join(sorted(failed))
+                    del pending[item]
+
+        if errors:
+            raise CacApiError("Changes to server %s failed: %s" % (
+                self['sid'], "; ".join("%s: %s" % error for error in sorted(errors.items()))))
+        return changes
+
     @staticmethod
-    def check_server_status(api, servername, status):
+    def check_server_status(api, servername, status, server_id=None, leave=False):
         def f():
-            server = get_server(api, server_name=servername)
-            if server and server['status'] == status:
+            server = get_server(api, server_id=server_id, server_name=servername)
+            if server and (server['status'] != status if leave else server['status'] == status):
                 return server
 
         return f
 
     @staticmethod
-    def build_server(api, cpu, ram, disk, template, label, wait=False, wait_timeout=300):
+    def build_server(api, cpu, ram, disk, template, label, wait=False, wait_timeout=300, deadline=None):
         """
         Build a server with the provided parameters
 
@@ -370,6 +598,7 @@ class CACServer(MutableMapping):
         :param template: OS Template to use (id, or string)
         :param wait: Wait for server build to complete
         :param wait_timeout: Seconds to wait for build to complete
+        :param deadline: Deadline for the whole task, which cuts the wait short
         :return: ( request.Response, CACServer ) response from CAC server, CACServer object if build completed
         :raises CacApiError on any error
         """
@@ -404,8 +633,8 @@ class CACServer(MutableMapping):
         if response.get('result') == 'successful':
             # Optionally wait for the server to be Powered On.  Poll every 10s.
             if wait:
-                server = _poller(CACServer.check_server_status(api, response.get('servername'), 'Powered On'),
-                                 wait_timeout, 10)
+                server = wait_for_status(api, 'Powered On', wait_timeout, servername=response.get('servername'),
+                                         deadline=deadline)
                 # Set the label, so we can find it again in the future
                 if server:
                     server['label'] = label
@@ -417,7 +646,7 @@ class CACServer(MutableMapping):
                                                          (), defaultdict(str, **response)))
 
 
-def get_api(api_user, api_key):
+def get_api(api_user, api_key, deadline=None, check=True):
     try:
         if not api_key:
             api_key = os.environ['CAC_API_KEY']
@@ -428,32 +657,188 @@ def get_api(api_user, api_key):
             "api key from parameter or CAC_API_KEY environment variable" if not api_key else
             "api user from paramater or CAC_API_USER environment variable"))
 
-    api = CACPy(api_user, api_key)
+    if os.environ.get('CAC_CASSETTE'):
+        # Only needed for offline test and dry-run cycles, so don't require it otherwise.
+        from cloudatcost_ansible_module.cassette import cassette_api
+        api = cassette_api(api_user, api_key)
+    else:
+        # Each request gets the time left before the deadline as its timeout.
+        api = TimeoutCACPy(api_user, api_key, deadline)
 
-    check_ok(api.get_resources())
+    if check:
+        check_ok(api.get_resources())
     return api
 
 
+ARGUMENT_SPEC = dict(
+    state=dict(default='present',
+               choices=['active', 'present', 'started',
+                        'deleted', 'absent', 'stopped',
+                        'restarted']),
+    api_key=dict(type='str'),
+    api_user=dict(type='str'),
+    label=dict(type='str', aliases=['name']),
+    fqdn=dict(type='str'),
+    cpus=dict(type='int'),
+    ram=dict(type='int'),
+    storage=dict(type='int'),
+    template=dict(),
+    runmode=dict(type='str'),
+    server_id=dict(type='int', aliases=['sid']),
+    wait=dict(type='bool', default=False),
+    wait_timeout=dict(default=300),
+    timeout=dict(type='int'),
+)
+
+
+def module_params(args):
+    """
+    Return the module params for a task's args, as AnsibleModule would: aliases resolved, defaults filled in, and
+    ints and bools converted.  For running the module in-process, from the cac_server action plugin.
+
+    :raises ValueError on an unsupported option, or a value of the wrong type or not in its choices
+    """
+    aliases = {}
+    for (name, spec) in ARGUMENT_SPEC.items():
+        for alias in spec.get('aliases', ()):
+            aliases[alias] = name
+
+    params = {}
+    for (key, value) in args.items():
+        name = aliases.get(key, key)
+        if name not in ARGUMENT_SPEC:
+            raise ValueError("Unsupported parameter for cac_server: %s" % key)
+        params[name] = value
+
+    for (name, spec) in ARGUMENT_SPEC.items():
+        value = params.get(name, spec.get('default'))
+        if value is not None:
+            if spec.get('type') == 'int':
+                value = int(value)
+            elif spec.get('type') == 'bool' and not isinstance(value, bool):
+                value = ('%s' % value).lower() in ('1', 'true', 'yes', 'on', 'y', 't')
+            if 'choices' in spec and value not in spec['choices']:
+                raise ValueError("Value of %s must be one of: %s, got: %s" % (name, ", ".join(spec['choices']), value))
+        params[name] = value
+    return params
+
+
+# The power status each state leaves a server in, for is_converged
+_STATE_STATUS = {'present': 'Powered On', 'active': 'Powered On', 'started': 'Powered On', 'stopped': 'Powered Off'}
+
+
+def is_converged(params, record):
+    """
+    Whether a raw listservers record (or None, if there is no server) already matches the module params, so there is
+    nothing to do.  This is decided without a CACServer or templates, and only for the common cases: anything else is
+    left to the full reconciliation.
+    """
+    state = params.get('state')
+    if record is None:
+        return state in ('absent', 'deleted')
+    if state not in _STATE_STATUS or record.get('status') != _STATE_STATUS[state]:
+        return False
+    if params.get('label') and record.get('label') != params.get('label'):
+        return False
+    if params.get('fqdn') and record.get('rdns') != params.get('fqdn'):
+        return False
+    if params.get('runmode') and (record.get('mode') or '').lower() != params.get('runmode').lower():
+        return False
+    return True
+
+
+def reconcile(api, params, servers, deadline, check_mode=False):
+    """
+    Bring the server described by the module params to its desired state.
+
+    :param params: module params (see ARGUMENT_SPEC)
+    :param servers: listservers records to look the server up in, ie. from prefetch
+    :param deadline: Deadline for the task
+    :return: dict of the module result: changed, server (CACServer or None) and response (to a build).  If nothing
+             needed to change, server is the listservers record, whose template is the template's name rather than
+             its (name, id).
+    :raises CacApiError if the server can't be built or changed
+    """
+    changed = False
+    response = None
+
+    state = params.get('state')
+    label = params.get('label')
+    rdns = params.get('fqdn')
+    cpus = params.get('cpus')
+    runmode = params.get('runmode')
+    ram = params.get('ram')
+    storage = params.get('storage')
+    template = params.get('template')
+    server_id = params.get('server_id')
+    wait = params.get('wait')
+    wait_timeout = int(params.get('wait_timeout'))
+
+    with deadline.phase('lookup'):
+        record = find_record(servers, server_id, label)
+        if is_converged(params, record):
+            # The most common run: answer from the snapshot, without templates or another listservers.
+            return dict(changed=False, server=record, response=None)
+        # Templates are only listed from here on, by the first CACServer (or build)
+        server = CACServer(api, record) if record is not None else None
+
+    if state in ('absent', 'deleted'):
+        if server:
+            server['status'] = "Deleted"
+        else:
+            return dict(changed=False, server=None, response=None)
+    else:
+        # For any other state, we need a server object.
+        if not server:
+            if check_mode:
+                changed = True
+            else:
+                with deadline.phase('build'):
+                    server, response = CACServer.build_server(api, cpus, ram, storage, template, label, wait,
+                                                              wait_timeout, deadline)
+                if response['result'] == "successful":
+                    changed = True
+                else:
+                    raise CacApiError(
+                        "Build initiated but no server was returned.  Check CloudAtCost Panel.  You "
+                        "will need to manually set the server label in the panel before trying again."
+                        "Response: %s" % response)
+        if not server:
+            # We didn't wait for it to build, or it timed out
+            return dict(changed=True, server=None, response=response)
+
+        if state in ('present', 'active', 'started'):
+            server['status'] = 'Powered On'
+        elif state == 'stopped':
+            server['status'] = 'Powered Off'
+        elif state == 'restarted':
+            server['status'] = 'Restarted'
+
+        if label:
+            server['label'] = label
+        if rdns:
+            server['rdns'] = rdns
+        if runmode:
+            # runmode reports as "Normal" or "Safe", but the api only accepts "normal", or "safe"
+            if server['mode'].lower() != runmode.lower():
+                server['mode'] = runmode.lower()
+
+    if check_mode:
+        changed = server.check()
+        server = None
+    else:
+        # Judge by the pending changes rather than the result, which matches them once a wait succeeds.
+        if server.check():
+            changed = True
+        with deadline.phase('commit'):
+            server = server.commit(wait, wait_timeout, deadline)
+
+    return dict(changed=changed, server=server, response=response)
+
+
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            state=dict(default='present',
-                       choices=['active', 'present', 'started',
-                                'deleted', 'absent', 'stopped',
-                                'restarted']),
-            api_key=dict(type='str'),
-            api_user=dict(type='str'),
-            label=dict(type='str', aliases=['name']),
-            fqdn=dict(type='str'),
-            cpus=dict(type='int'),
-            ram=dict(type='int'),
-            storage=dict(type='int'),
-            template=dict(),
-            runmode=dict(type='str'),
-            server_id=dict(type='int', aliases=['sid']),
-            wait=dict(type='bool', default=False),
-            wait_timeout=dict(default=300),
-        ),
+        argument_spec=ARGUMENT_SPEC,
         supports_check_mode=True
     )
 
@@ -462,79 +847,24 @@ def main():
     if not HAS_CAC:
         module.fail_json(msg='CACPy required for this module')
 
-    changed = False
-    response = None
-
-    state = module.params.get('state')
-    label = module.params.get('label')
-    rdns = module.params.get('fqdn')
-    cpus = module.params.get('cpus')
-    runmode = module.params.get('runmode')
-    ram = module.params.get('ram')
-    storage = module.params.get('storage')
-    template = module.params.get('template')
-    server_id = module.params.get('server_id')
-    wait = module.params.get('wait')
-    wait_timeout = int(module.params.get('wait_timeout'))
+    # One deadline for the whole task: every API call and poll gets the time that is left.
+    deadline = Deadline(module.params.get('timeout') or int(module.params.get('wait_timeout')) + 60)
 
     try:
-        api = get_api(module.params.get('api_user'), module.params.get('api_key'))
-        server = get_server(api, server_id=server_id, label=label)
-
-        if state in ('absent', 'deleted'):
-            if server:
-                server['status'] = "Deleted"
-            else:
-                module.exit_json(changed=False, server=None, response=None)
-        else:
-            # For any other state, we need a server object.
-            if not server:
-                if module.check_mode:
-                    changed = True
-                else:
-                    server, response = CACServer.build_server(api, cpus, ram, storage, template, label, wait,
-                                                              wait_timeout)
-                    if response['result'] == "successful":
-                        changed = True
-                    else:
-                        module.fail_json(
-                            msg="Build initiated but no server was returned.  Check CloudAtCost Panel.  You "
-                                "will need to manually set the server label in the panel before trying again."
-                                "Response: %s" % response)
-            if not server:
-                # We didn't wait for it to build, or it timed out
-                module.exit_json(changed=True, server=None, response=response)
-
-            if state in ('present', 'active', 'started'):
-                server['status'] = 'Powered On'
-            elif state == 'stopped':
-                server['status'] = 'Powered Off'
-            elif state == 'restarted':
-                server['status'] = 'Restarted'
-
-            if label:
-                server['label'] = label
-            if rdns:
-                server['rdns'] = rdns
-            if runmode:
-                # runmode reports as "Normal" or "Safe", but the api only accepts "normal", or "safe"
-                if server['mode'].lower() != runmode.lower():
-                    server['mode'] = runmode.lower()
-
-        if module.check_mode:
-            changed = server.check()
-            server = None
-        else:
-            updated = server.commit()
-            if updated != server:
-                changed = True
-                server = updated
-
-        module.exit_json(changed=changed, server=server, response=response)
-
+        with deadline.phase('connect'):
+            # listservers fails with bad credentials too, so it is the only read a converged server needs.
+            # Templates are only listed if a server has to be built or changed.
+            api = get_api(module.params.get('api_user'), module.params.get('api_key'), deadline, check=False)
+            servers = prefetch(api, templates=False, check=False, server_id=module.params.get('server_id'),
+                               label=module.params.get('label'))
+        result = reconcile(api, module.params, servers, deadline, module.check_mode)
+    except DeadlineExceeded as e:
+        module.fail_json(msg='%s' % e, timings=deadline.timings())
     except Exception as e:
         module.fail_json(msg='%s' % e.message)
 
+    module.exit_json(**result)
+
 
 if __name__ == '__main__':
     main()
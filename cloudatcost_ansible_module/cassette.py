@@ -0,0 +1,106 @@
+"""
+Record/replay of CloudAtCost API exchanges at the CACPy boundary.
+
+Set the following environment variables to have cac_server and cac_inv.py use a cassette instead of (or as well as)
+the live API:
+
+CAC_CASSETTE
+    Path to the cassette file.
+CAC_CASSETTE_MODE
+    ``record`` to call the live API and save every exchange to the cassette, or ``replay`` (default) to serve
+    responses from the cassette without any network access.
+CAC_CASSETTE_LATENCY
+    Seconds to sleep before each replayed response, to simulate API latency (default: 0)
+
+Secrets (root and VNC passwords, API keys) are scrubbed from cassettes as they are recorded.
+"""
+import json
+import os
+import time
+
+from cacpy import CACPy
+
+SCRUBBED = '<scrubbed>'
+SECRET_FIELDS = ('rootpass', 'vncpass', 'api_key', 'key')
+
+
+class CassetteError(Exception):
+    """
+    Raised when a replayed request has no matching exchange in the cassette
+    """
+
+
+def scrub(value):
+    """ Return a copy of a request or response with any secret fields replaced. """
+    if isinstance(value, dict):
+        return dict((k, SCRUBBED if k in SECRET_FIELDS else scrub(v)) for (k, v) in value.items())
+    if isinstance(value, list):
+        return [scrub(v) for v in value]
+    return value
+
+
+def _request_key(endpoint, options, type):
+    # Everything goes over HTTP as a string, so 123 and '123' are the same request.
+    return json.dumps([type, endpoint, dict((k, str(v)) for (k, v) in options.items())], sort_keys=True)
+
+
+class RecordingCACPy(CACPy):
+    """ CACPy that saves every exchange with the API to a cassette file. """
+
+    def __init__(self, email, api_key, path):
+        CACPy.__init__(self, email, api_key)
+        self.path = path
+        self.interactions = []
+
+    def _make_request(self, endpoint, options=dict(), type="GET"):
+        response = CACPy._make_request(self, endpoint, options, type)
+        self.interactions.append({'endpoint': endpoint, 'type': type, 'options': scrub(dict(options)),
+                                  'response': scrub(response)})
+        # Save after every call; modules exit abruptly via exit_json/fail_json.
+        with open(self.path, 'w') as f:
+            json.dump({'version': 1, 'interactions': self.interactions}, f, indent=2, sort_keys=True)
+        return response
+
+
+class ReplayCACPy(CACPy):
+    """
+    CACPy that serves responses from a cassette file.
+
+    Matching requests are answered in the order they were recorded.  Once they run out, the last response is repeated,
+    so status polls settle on the final recorded state.
+    """
+
+    def __init__(self, email, api_key, path, latency=0):
+        CACPy.__init__(self, email, api_key)
+        self.latency = latency
+        self._responses = {}
+
+        with open(path) as f:
+            cassette = json.load(f)
+        for interaction in cassette['interactions']:
+            key = _request_key(interaction['endpoint'], interaction['options'], interaction['type'])
+            self._responses.setdefault(key, []).append(interaction['response'])
+
+    def _make_request(self, endpoint, options=dict(), type="GET"):
+        responses = self._responses.get(_request_key(endpoint, scrub(dict(options)), type))
+        if not responses:
+            raise CassetteError("No recorded response for %s %s %s" % (type, endpoint, options))
+        if self.latency:
+            time.sleep(self.latency)
+        return responses.pop(0) if len(responses) > 1 else responses[0]
+
+
+def cassette_api(api_user, api_key, environ=os.environ):
+    """
+    Return a CACPy instance for the cassette configured in the environment, or None if CAC_CASSETTE is not set.
+    """
+    path = environ.get('CAC_CASSETTE')
+    if not path:
+        return None
+
+    mode = environ.get('CAC_CASSETTE_MODE', 'replay')
+    if mode == 'record':
+        return RecordingCACPy(api_user, api_key, path)
+    elif mode == 'replay':
+        return ReplayCACPy(api_user, api_key, path, float(environ.get('CAC_CASSETTE_LATENCY', 0)))
+    raise ValueError("CAC_CASSETTE_MODE must be 'record' or 'replay', not: %s" % mode)
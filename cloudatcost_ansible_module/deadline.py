@@ -0,0 +1,61 @@
+"""
+A single deadline for a whole task, shared by every CloudAtCost API call and poll it makes.
+"""
+import time
+from contextlib import contextmanager
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a task runs out of time
+    """
+
+
+class Deadline(object):
+    """
+    Track the time left before a deadline, and how long each phase of the task took.
+
+    remaining() is meant to be used as the timeout of each request, and raises DeadlineExceeded once there is no
+    time left, so the task fails fast instead of starting another call.
+    """
+
+    def __init__(self, timeout, clock=None):
+        self.timeout = timeout
+        # Looked up now rather than at import, so a patched time.time (ie. a test's virtual clock) is used.
+        self.clock = clock or time.time
+        self.expires = self.clock() + timeout
+        self.phases = []
+        self.current = None
+        self._current_start = None
+
+    def remaining(self):
+        """ Return the seconds left before the deadline.  Raises DeadlineExceeded if there are none. """
+        left = self.expires - self.clock()
+        if left <= 0:
+            raise DeadlineExceeded(self.report())
+        return left
+
+    @contextmanager
+    def phase(self, name):
+        """ Time a phase of the task, for the report if the deadline is exceeded. """
+        self.current, self._current_start = name, self.clock()
+        try:
+            yield
+        finally:
+            self.phases.append((name, self.clock() - self._current_start))
+            self.current = None
+
+    def timings(self):
+        """ Return the seconds spent in each completed phase """
+        timings = {}
+        for (name, seconds) in self.phases:
+            timings[name] = round(timings.get(name, 0) + seconds, 3)
+        return timings
+
+    def report(self):
+        phases = list(self.phases)
+        if self.current:
+            phases.append((self.current, self.clock() - self._current_start))
+        spent = ", ".join("%s %.1fs" % (name, seconds) for (name, seconds) in phases)
+        return "Deadline of %ss exceeded%s. Time spent: %s" % (
+            self.timeout, " during %s" % self.current if self.current else "", spent or "none")
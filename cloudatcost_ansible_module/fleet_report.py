@@ -0,0 +1,122 @@
+"""
+Utilization report for a fleet of servers, from their listservers records.
+
+listservers returns every number as a string.  FleetColumns parses the ones the report needs once, into one typed
+array per field, and the report is computed a column at a time from those.  Missing or unparseable values are NaN,
+and left out of percentiles and totals.
+"""
+import csv
+import math
+from array import array
+
+# Numeric listservers fields, in the units CloudAtCost reports them: cpu (cores), ram (MB), storage (GB), cpuusage
+# (percent), ramusage (MB) and hdusage (GB).
+NUMERIC_FIELDS = ('cpu', 'ram', 'storage', 'cpuusage', 'ramusage', 'hdusage')
+GROUP_FIELDS = ('template', 'mode', 'status')
+PERCENTILES = (50, 90, 95, 99)
+
+# A server is over-provisioned if its cpu and ram utilization are both below this percentage, and under-provisioned
+# if its cpu, ram or disk utilization is above UNDER_PROVISIONED_ABOVE.
+OVER_PROVISIONED_BELOW = 20.0
+UNDER_PROVISIONED_ABOVE = 90.0
+
+NAN = float('nan')
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def _ratio(used, total):
+    return [u / t * 100 if t > 0 else NAN for (u, t) in zip(used, total)]
+
+
+class FleetColumns(object):
+    """ The report's fields of a list of server records, one array per field """
+
+    def __init__(self, servers):
+        self.label = [server.get('label') for server in servers]
+        for field in NUMERIC_FIELDS:
+            setattr(self, field, array('d', [_number(server.get(field)) for server in servers]))
+        for field in GROUP_FIELDS:
+            setattr(self, field, [server.get(field) for server in servers])
+
+    def __len__(self):
+        return len(self.label)
+
+    def utilization(self):
+        """ Return the cpu, ram and disk utilization (percent) of each server, as arrays """
+        return dict(cpu=self.cpuusage,
+                    ram=array('d', _ratio(self.ramusage, self.ram)),
+                    disk=array('d', _ratio(self.hdusage, self.storage)))
+
+
+def percentiles(values, points=PERCENTILES):
+    """ Return the given percentiles (linearly interpolated) and the max of values, ignoring NaN """
+    ordered = sorted(v for v in values if not math.isnan(v))
+    if not ordered:
+        return None
+    result = {}
+    for point in points:
+        rank = (len(ordered) - 1) * point / 100.0
+        low = int(math.floor(rank))
+        high = min(low + 1, len(ordered) - 1)
+        result['p%d' % point] = round(ordered[low] + (ordered[high] - ordered[low]) * (rank - low), 3)
+    result['max'] = ordered[-1]
+    return result
+
+
+def totals_by(columns, field):
+    """ Return the number of servers, and their total cpu, ram and storage, for each value of field """
+    totals = {}
+    for (key, cpu, ram, storage) in zip(getattr(columns, field), columns.cpu, columns.ram, columns.storage):
+        group = totals.setdefault('%s' % key, dict(servers=0, cpu=0.0, ram=0.0, storage=0.0))
+        group['servers'] += 1
+        for (name, value) in (('cpu', cpu), ('ram', ram), ('storage', storage)):
+            if not math.isnan(value):
+                group[name] += value
+    return totals
+
+
+def fleet_report(servers, over_below=OVER_PROVISIONED_BELOW, under_above=UNDER_PROVISIONED_ABOVE):
+    """
+    Report on the utilization of a list of server records.
+
+    :return: dict of the number of servers, utilization percentiles (cpu, ram, disk), the labels of over- and
+             under-provisioned servers, and totals by template, mode and status
+    """
+    columns = FleetColumns(servers)
+    utilization = columns.utilization()
+
+    # NaN compares False, so servers without usage figures are neither.
+    over = [label for (label, cpu, ram) in zip(columns.label, utilization['cpu'], utilization['ram'])
+            if cpu < over_below and ram < over_below]
+    under = [label for (label, cpu, ram, disk) in zip(columns.label, utilization['cpu'], utilization['ram'],
+                                                      utilization['disk'])
+             if cpu > under_above or ram > under_above or disk > under_above]
+
+    return dict(servers=len(columns),
+                utilization=dict((name, percentiles(values)) for (name, values) in utilization.items()),
+                over_provisioned=over,
+                under_provisioned=under,
+                totals=dict((field, totals_by(columns, field)) for field in GROUP_FIELDS))
+
+
+def write_csv(report, out):
+    """ Write a report as CSV rows of section, group, name and value """
+    writer = csv.writer(out)
+    writer.writerow(['section', 'group', 'name', 'value'])
+    writer.writerow(['servers', '', 'count', report['servers']])
+    for (resource, stats) in sorted(report['utilization'].items()):
+        for (name, value) in sorted((stats or {}).items()):
+            writer.writerow(['utilization', resource, name, value])
+    for section in ('over_provisioned', 'under_provisioned'):
+        for label in report[section]:
+            writer.writerow([section, '', 'label', label])
+    for (field, groups) in sorted(report['totals'].items()):
+        for (key, totals) in sorted(groups.items()):
+            for (name, value) in sorted(totals.items()):
+                writer.writerow(['totals', '%s=%s' % (field, key), name, value])
@@ -0,0 +1,95 @@
+"""
+A local SQLite copy of the listservers data of one or more accounts, indexed for fast lookups.
+
+cac_inv.py keeps it up to date when it lists servers, and answers --host and --query from it without calling the
+CloudAtCost API.
+
+The records hold root passwords, so the database is only readable by the current user.
+"""
+import json
+import os
+import sqlite3
+import time
+
+# Server fields that can be queried, each with its own column and index.
+INDEXED_FIELDS = ('sid', 'label', 'ip', 'status', 'template')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    account TEXT NOT NULL,
+    sid TEXT,
+    label TEXT,
+    ip TEXT,
+    status TEXT,
+    template TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS servers_account ON servers (account);
+CREATE INDEX IF NOT EXISTS servers_sid ON servers (sid);
+CREATE INDEX IF NOT EXISTS servers_label ON servers (label);
+CREATE INDEX IF NOT EXISTS servers_ip ON servers (ip);
+CREATE INDEX IF NOT EXISTS servers_status ON servers (status);
+CREATE INDEX IF NOT EXISTS servers_template ON servers (template);
+CREATE TABLE IF NOT EXISTS accounts (
+    account TEXT PRIMARY KEY,
+    refreshed REAL NOT NULL
+);
+"""
+
+
+class FleetStore(object):
+    """ Server records of one or more accounts, stored in SQLite """
+
+    def __init__(self, path, clock=time.time):
+        self.clock = clock
+        # Create it private, and make one from before this was done private too.  SQLite gives its journal the same
+        # mode.
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, account, servers):
+        """ Replace the stored servers of an account with a new listservers snapshot """
+        with self.db:
+            self.db.execute("DELETE FROM servers WHERE account = ?", (account,))
+            self.db.executemany(
+                "INSERT INTO servers (account, sid, label, ip, status, template, record) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((account,) + tuple(server.get(field) for field in INDEXED_FIELDS) + (json.dumps(server),)
+                 for server in servers))
+            self.db.execute("INSERT OR REPLACE INTO accounts (account, refreshed) VALUES (?, ?)",
+                            (account, self.clock()))
+
+    def age(self, account):
+        """ Return the seconds since the account was last refreshed, or None if it never was """
+        row = self.db.execute("SELECT refreshed FROM accounts WHERE account = ?", (account,)).fetchone()
+        return self.clock() - row[0] if row else None
+
+    def servers(self, account):
+        """ Return the stored servers of an account, in listservers order """
+        return self.query(account=account)
+
+    def query(self, **criteria):
+        """
+        Return the servers matching all of the criteria, ie. query(status='Installing', template='CentOS-7-64bit')
+
+        :raises KeyError if a criterion isn't an indexed field or 'account'
+        """
+        unknown = set(criteria) - set(INDEXED_FIELDS + ('account',))
+        if unknown:
+            raise KeyError("Can't query servers by: %s.  Use one of: %s" % (
+                ", ".join(sorted(unknown)), ", ".join(INDEXED_FIELDS + ('account',))))
+        fields = sorted(criteria)
+        where = " AND ".join("%s = ?" % field for field in fields) or "1"
+        rows = self.db.execute("SELECT record FROM servers WHERE %s ORDER BY rowid" % where,
+                               tuple(criteria[field] for field in fields))
+        return [json.loads(record) for (record,) in rows]
+
+    def get(self, label):
+        """ Return the first server with the label, or None """
+        row = self.db.execute("SELECT record FROM servers WHERE label = ? ORDER BY rowid LIMIT 1",
+                              (label,)).fetchone()
+        return json.loads(row[0]) if row else None
@@ -0,0 +1,149 @@
+"""
+A listservers and listtemplates snapshot shared by the processes that run one cac_server task for a batch of hosts.
+
+Ansible runs the task for each host in its own worker process.  The first to ask for a snapshot fetches it with
+prefetch() and saves it, under an exclusive lock, and the others wait for the lock and read it, so the batch costs one
+read of each list.  A host that changes its server invalidates the snapshot, so later tasks (ie. the next loop item)
+see the change.
+
+Snapshots hold root passwords, so they are only readable by the current user, in a directory only it can use.  The
+directory's name is predictable, so one that another user created, or made accessible, is refused.
+
+SnapshotIndex answers field=value queries on a snapshot (ie. for the cac_server lookup plugin).
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+
+from cloudatcost_ansible_module.cac_server import prefetch, CACTemplate
+
+
+def snapshot_dir():
+    return os.path.join(tempfile.gettempdir(), 'cac-snapshots-%d' % os.getuid())
+
+
+def _private_dir(directory):
+    """ Create directory if need be, and check that it is a directory only the current user can use """
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise OSError(errno.EPERM, "Refusing to use %s for snapshots, as it isn't a directory private to uid %d" % (
+            directory, os.getuid()))
+
+
+def _path(key, directory):
+    return os.path.join(directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def shared_snapshot(api, key, directory=None, max_age=3600, templates=True, check=False):
+    """
+    Return the server records of the snapshot for key, fetching it if no other process has yet.  Also fills the
+    CACTemplate cache, if templates is set.
+
+    :param key: identifies the processes sharing the snapshot (ie. a task and batch of hosts), and the account
+    :param max_age: seconds after which a snapshot is fetched again, and old snapshots are removed
+    :param check: also check the credentials with get_resources.  listservers fails with bad credentials too, so this
+                  is only needed if templates are read on their own.
+    """
+    directory = directory or snapshot_dir()
+    _private_dir(directory)
+    path = _path(key, directory)
+
+    with _lock(path + '.lock') as lock:
+        try:
+            if os.path.exists(path) and os.path.getmtime(path) + max_age > time.time():
+                with open(path) as f:
+                    snapshot = json.load(f)
+                if snapshot['templates']:
+                    CACTemplate.templates = snapshot['templates']
+                return snapshot['servers']
+
+            servers = prefetch(api, templates, check=check)
+            # Each writer has its own temporary file, and the snapshot is replaced in one rename.
+            (fd, tmp_path) = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(servers=servers, templates=CACTemplate.templates if templates else []), f)
+            os.rename(tmp_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    _remove_old(directory, max_age)
+    return servers
+
+
+def _lock(lock_path):
+    """
+    Open and exclusively lock lock_path.  _remove_old() may remove an old lock file, so if the file locked is no longer
+    the one at lock_path, it is opened and locked again.
+    """
+    while True:
+        lock = open(lock_path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path)):
+                return lock
+        except OSError:
+            pass
+        lock.close()
+
+
+def invalidate(key, directory=None):
+    """ Remove the snapshot for key, so the next task to ask for it fetches a new one """
+    try:
+        os.unlink(_path(key, directory or snapshot_dir()))
+    except OSError:
+        pass
+
+
+def _remove_old(directory, max_age):
+    """ Remove files older than max_age.  A lock file is only removed while this process holds it. """
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) + max_age >= time.time():
+                continue
+            if not name.endswith('.lock'):
+                os.unlink(path)
+                continue
+            with open(path, 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+class SnapshotIndex(object):
+    """ Server records, indexed by each field the first time it is queried """
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.indexes = {}
+
+    def index(self, field):
+        if field not in self.indexes:
+            index = {}
+            for server in self.servers:
+                index.setdefault('%s' % server.get(field), []).append(server)
+            self.indexes[field] = index
+        return self.indexes[field]
+
+    def find(self, **criteria):
+        """ Return the servers whose fields equal every criterion (compared as strings), in listservers order """
+        if not criteria:
+            return list(self.servers)
+        fields = sorted(criteria)
+        candidates = self.index(fields[0]).get('%s' % criteria[fields[0]], [])
+        return [server for server in candidates
+                if all('%s' % server.get(field) == '%s' % criteria[field] for field in fields[1:])]
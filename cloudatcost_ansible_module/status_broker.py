@@ -0,0 +1,219 @@
+"""
+Local status broker for long CloudAtCost build and power waits.
+
+Rather than every waiting cac_server task polling listservers on its own, one broker process polls the account and
+answers waiters over a Unix socket.  While someone is waiting, it polls quickly as servers change, and backs off to
+max_interval while nothing changes.  With nobody waiting, it only polls every max_interval.
+
+Start it with the usual CAC_API_USER and CAC_API_KEY environment variables:
+
+    python -m cloudatcost_ansible_module.status_broker --socket /tmp/cac-status.sock
+
+and point cac_server at it with CAC_STATUS_BROKER=/tmp/cac-status.sock.  If the broker can't be reached, cac_server
+falls back to polling the API itself.
+
+Protocol: the client sends one JSON line with the sid or servername, the status to wait for, a timeout in seconds
+and optionally the time since which the status must have been seen, and whether to wait for the server to leave the
+status instead.  The broker answers with one JSON line: the server record once it has (or has left) that status, or
+null on timeout.
+"""
+import argparse
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+
+class StatusBroker(object):
+    """ Poll listservers on an adaptive schedule, and wake waiters when a server's status changes. """
+
+    def __init__(self, api, min_interval=2, max_interval=60, backoff=1.5, clock=None):
+        """
+        :param clock: provides time() and condition(), ie. a test's virtual clock.  Defaults to time.time and
+                      threading.Condition.
+        """
+        self.api = api
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.servers = {}
+        self.polled = None
+        self.waiters = 0
+        self.clock = clock.time if clock else time.time
+        # Notified when the servers are polled, and when the poller is woken or stopped
+        self._changed = clock.condition() if clock else threading.Condition()
+        self._woken = False
+        self._stopped = False
+
+    def poll(self):
+        """ Refresh the server list, and wake any waiters.  Returns True if any server's status changed. """
+        started = self.clock()
+        response = self.api.get_server_info()
+        if response.get('status') != 'ok':
+            return False
+
+        servers = dict((server['sid'], server) for server in response['data'])
+        with self._changed:
+            changed = set((sid, s['status']) for (sid, s) in servers.items()) != \
+                set((sid, s['status']) for (sid, s) in self.servers.items())
+            self.servers = servers
+            self.polled = started
+            self._changed.notify_all()
+        return changed
+
+    def run(self):
+        """
+        Poll until stopped.  While anyone is waiting, poll at min_interval while servers change, and back off while
+        nothing changes.  With nobody waiting, poll every max_interval.
+        """
+        while True:
+            with self._changed:
+                if self._stopped:
+                    return
+                # Taken as the poll starts: a waiter arriving during it wakes the poller for another.
+                (woken, self._woken, waiting) = (self._woken, False, self.waiters)
+            try:
+                changed = self.poll()
+            except Exception:
+                changed = False
+            with self._changed:
+                if not waiting:
+                    self.interval = self.max_interval
+                elif changed or woken:
+                    # A new waiter wants a fresh answer: poll quickly until things settle.
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * self.backoff, self.max_interval)
+                self._sleep(self.clock() + self.interval)
+
+    def _sleep(self, until):
+        """ Wait until the time, or until woken or stopped.  Called with _changed held. """
+        while not (self._woken or self._stopped):
+            remaining = until - self.clock()
+            if remaining <= 0:
+                break
+            self._changed.wait(remaining)
+
+    def _wake(self):
+        """ Poll now.  Called with _changed held. """
+        self._woken = True
+        self._changed.notify_all()
+
+    def stop(self):
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+
+    def find(self, sid=None, servername=None):
+        for server in self.servers.values():
+            if (sid is not None and server['sid'] == str(sid)) or \
+                    (servername is not None and server['servername'] == servername):
+                return server
+
+    def wait_for_status(self, status, sid=None, servername=None, timeout=300, since=None, leave=False):
+        """
+        Block until the server has the requested status (or, if leave is set, any other status), and return its
+        record.  Returns None on timeout.
+
+        If since is given, only a listservers response requested after that time counts, ie. the time a power change
+        was made, so the status from before the change isn't mistaken for its result.
+        """
+        deadline = self.clock() + timeout
+        with self._changed:
+            self.waiters += 1
+            self._wake()
+            try:
+                while True:
+                    server = self.find(sid, servername)
+                    if server and (server['status'] != status if leave else server['status'] == status) and \
+                            (since is None or self.polled >= since):
+                        return server
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return None
+                    self._changed.wait(remaining)
+            finally:
+                self.waiters -= 1
+
+
+class _WaitHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        server = self.server.broker.wait_for_status(request['status'], sid=request.get('sid'),
+                                                    servername=request.get('servername'),
+                                                    timeout=request.get('timeout', 300),
+                                                    since=request.get('since'), leave=request.get('leave', False))
+        self.wfile.write((json.dumps(server) + '\n').encode('utf-8'))
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, broker):
+        """
+        :raises socket.error if something other than a socket (ie. a left-over one) is at socket_path
+        """
+        if os.path.lexists(socket_path):
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise socket.error("Refusing to replace %s, which is not a socket" % socket_path)
+            os.unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, _WaitHandler)
+        self.broker = broker
+
+
+def wait_for_status(socket_path, status, sid=None, servername=None, timeout=300, since=None, leave=False):
+    """
+    Ask the broker listening on socket_path to wait for a server to reach status (or leave it, if leave is set).
+
+    :return: the server record (dict) or None if the timeout expired
+    :raises socket.error if the broker can't be reached
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Leave the broker time to answer after its own timeout.
+    sock.settimeout(timeout + 30)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(dict(status=status, sid=sid, servername=servername, timeout=timeout,
+                                      since=since, leave=leave)) + '\n').encode('utf-8'))
+        line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not line:
+        raise socket.error("Status broker at %s closed the connection" % socket_path)
+    return json.loads(line.decode('utf-8'))
+
+
+def main():
+    from cloudatcost_ansible_module.cac_server import get_api
+
+    parser = argparse.ArgumentParser(description='Serve CloudAtCost server status changes over a Unix socket')
+    parser.add_argument('--socket', required=True, help='Path of the Unix socket to listen on')
+    parser.add_argument('--min-interval', type=float, default=2,
+                        help='Seconds between polls while servers are changing (default: 2)')
+    parser.add_argument('--max-interval', type=float, default=60,
+                        help='Longest time between polls when nothing is changing (default: 60)')
+    args = parser.parse_args()
+
+    broker = StatusBroker(get_api(None, None), args.min_interval, args.max_interval)
+    poller = threading.Thread(target=broker.run)
+    poller.daemon = True
+    poller.start()
+
+    server = BrokerServer(args.socket, broker)
+    try:
+        server.serve_forever()
+    finally:
+        broker.stop()
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
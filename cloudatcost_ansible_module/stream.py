@@ -0,0 +1,203 @@
+"""
+Incremental parsing of CloudAtCost list responses, and the HTTP requests behind them.
+
+CACPy loads the whole listservers response into memory, including fields that are never used.  iter_server_info()
+instead streams the response and yields one server record at a time, keeping only the requested fields, so callers
+can stop reading as soon as they have found what they need.
+
+TimeoutCACPy gives each request the time remaining before a Deadline as its timeout.
+"""
+import codecs
+import json
+import re
+
+import requests
+from cacpy import CACPy
+from cacpy.CACPy import BASE_URL, API_VERSION, LIST_SERVERS_URL, LIST_TEMPLATES_URL
+
+from cloudatcost_ansible_module.deadline import DeadlineExceeded
+
+CHUNK_SIZE = 65536
+
+# CACPy request methods for each list endpoint, for APIs that don't talk HTTP themselves (ie. cassettes and mocks).
+_API_METHODS = {LIST_SERVERS_URL: 'get_server_info', LIST_TEMPLATES_URL: 'get_template_info'}
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _unwrap(method):
+    return getattr(method, '__func__', method)
+
+
+class TimeoutCACPy(CACPy):
+    """ CACPy whose requests time out when the deadline expires """
+
+    def __init__(self, email, api_key, deadline=None):
+        CACPy.__init__(self, email, api_key)
+        self.deadline = deadline
+
+    def _make_request(self, endpoint, options=dict(), type="GET"):
+        return http_request(self, endpoint, options, type).json()
+
+
+def request_timeout(api):
+    """ Return the time left before the api's deadline, or None if it has none """
+    deadline = getattr(api, 'deadline', None)
+    return deadline.remaining() if deadline is not None else None
+
+
+def http_request(api, endpoint, options=dict(), type="GET", stream=False):
+    """ Make a CACPy request, with the time left before the api's deadline as the timeout. """
+    data = dict(options)
+    data.update(key=api.api_key, login=api.email)
+    url = BASE_URL + API_VERSION + endpoint
+
+    try:
+        if type == "GET":
+            return requests.get(url, params=data, timeout=request_timeout(api), stream=stream)
+        elif type == "POST":
+            return requests.post(url, data=data, timeout=request_timeout(api), stream=stream)
+    except requests.exceptions.Timeout as e:
+        raise DeadlineExceeded(api.deadline.report() if getattr(api, 'deadline', None) else '%s' % e)
+    raise Exception("InvalidRequestType: " + str(type))
+
+
+# Request implementations that talk HTTP directly, and can be streamed.
+_HTTP_MAKE_REQUESTS = (_unwrap(CACPy._make_request), _unwrap(TimeoutCACPy._make_request))
+
+
+class _ChunkReader(object):
+    """ Read JSON values from an iterable of text chunks, only buffering what hasn't been parsed yet. """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Skip whitespace, and return the next character """
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '%s' in JSON response at: %s" % (char, self.buf[self.pos:self.pos + 40]))
+        self.pos += 1
+
+    def skip(self, char):
+        """ Consume char if it is next, and return whether it was """
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # Incomplete value.  Read more and try again.
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk.
+            if end == len(self.buf) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def project(record, fields=None):
+    """ Return a copy of record with only the given fields, or the record itself if fields is None. """
+    if fields is None:
+        return record
+    return dict((k, v) for (k, v) in record.items() if k in fields)
+
+
+def iter_records(chunks, fields=None, header=None):
+    """
+    Parse a CloudAtCost response of the form {..., "data": [{...}, ...], ...} from an iterable of text chunks, and
+    yield each record in data as soon as it has been parsed.
+
+    :param chunks: iterable of text
+    :param fields: names of the fields to keep in each record (default: all)
+    :param header: dict to fill with the other top-level keys of the response (ie. status, error_description).  Keys
+                   after the data are only available once the generator is exhausted.
+    """
+    if header is None:
+        header = {}
+    reader = _ChunkReader(chunks)
+
+    reader.expect('{')
+    if reader.skip('}'):
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'data' and reader.peek() == '[':
+            reader.expect('[')
+            if not reader.skip(']'):
+                while True:
+                    yield project(reader.value(), fields)
+                    if not reader.skip(','):
+                        break
+                reader.expect(']')
+        else:
+            header[key] = reader.value()
+        if not reader.skip(','):
+            break
+    reader.expect('}')
+
+
+def _http_chunks(api, endpoint):
+    response = http_request(api, endpoint, stream=True)
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            # The timeout only applies to each read, so check the deadline between them too.
+            request_timeout(api)
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    finally:
+        response.close()
+
+
+def iter_response(api, endpoint, fields=None, header=None):
+    """
+    Yield the records of a CloudAtCost list endpoint, streamed from the API if api is a plain CACPy or TimeoutCACPy.
+
+    Other API objects (ie. cassettes and mocks) are asked for the whole response through their CACPy method, and
+    its records are projected in the same way.
+    """
+    if header is None:
+        header = {}
+    if _unwrap(getattr(api, '_make_request', None)) in _HTTP_MAKE_REQUESTS:
+        for record in iter_records(_http_chunks(api, endpoint), fields, header):
+            yield record
+    else:
+        response = getattr(api, _API_METHODS[endpoint])()
+        header.update((k, v) for (k, v) in response.items() if k != 'data')
+        for record in response.get('data') or []:
+            yield project(record, fields)
+
+
+def iter_server_info(api, fields=None, header=None):
+    """ Yield the server records from listservers.  See iter_response. """
+    return iter_response(api, LIST_SERVERS_URL, fields, header)
@@ -0,0 +1,75 @@
+"""
+Lookup plugin for CloudAtCost servers.
+
+    {{ lookup('cac_server', 'label=web1', attr='ip') }}
+    {{ lookup('cac_server', 'status=Installing,template=CentOS-7-64bit', attr='label', wantlist=True) }}
+    {{ lookup('cac_server', 'web1') }}    # a term without '=' is a label; returns the whole server record
+
+Each term is a comma-separated list of field=value criteria, and returns every matching server (or its attr).
+
+Servers come from one listservers snapshot per account for the whole ansible-playbook run.  It is shared by Ansible's
+worker processes through cloudatcost_ansible_module.snapshot, and indexed in each process, so any number of lookups
+costs one API read.  Pass refresh=True to fetch a new snapshot, ie. after changing servers earlier in the play.
+
+Enable it by adding this directory to lookup_plugins in ansible.cfg.  api_user and api_key can be passed as options,
+or set in the CAC_API_USER and CAC_API_KEY environment variables.
+"""
+import multiprocessing
+import os
+
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+
+try:
+    from cloudatcost_ansible_module import cac_server, snapshot
+
+    HAS_CAC = cac_server.HAS_CAC
+except ImportError:
+    HAS_CAC = False
+
+# SnapshotIndex for each snapshot key, for the life of this process
+_indexes = {}
+
+
+def run_id():
+    """ Return the pid of the ansible-playbook process, which its worker processes share """
+    if multiprocessing.current_process().name == 'MainProcess':
+        return os.getpid()
+    return os.getppid()
+
+
+def parse_term(term):
+    """ Parse 'field=value[,field=value...]', or a bare label, into criteria """
+    if '=' not in term:
+        return dict(label=term.strip())
+    try:
+        return dict((field.strip(), value.strip()) for (field, value) in
+                    (criterion.split('=', 1) for criterion in term.split(',') if criterion.strip()))
+    except ValueError:
+        raise AnsibleError("Invalid cac_server lookup: %s.  Use field=value[,field=value...]" % term)
+
+
+class LookupModule(LookupBase):
+    def run(self, terms, variables=None, **kwargs):
+        if not HAS_CAC:
+            raise AnsibleError('CACPy and cloudatcost_ansible_module are required for the cac_server lookup')
+
+        api_user = kwargs.get('api_user') or os.environ.get('CAC_API_USER')
+        key = 'lookup %s %s' % (api_user, run_id())
+        if kwargs.get('refresh'):
+            snapshot.invalidate(key)
+            _indexes.pop(key, None)
+
+        if key not in _indexes:
+            try:
+                api = cac_server.get_api(api_user, kwargs.get('api_key'), check=False)
+                _indexes[key] = snapshot.SnapshotIndex(snapshot.shared_snapshot(api, key, templates=False, check=False))
+            except Exception as e:
+                raise AnsibleError("Unable to list CloudAtCost servers: %s" % e)
+
+        attr = kwargs.get('attr')
+        results = []
+        for term in terms:
+            for server in _indexes[key].find(**parse_term(term)):
+                results.append(server.get(attr) if attr else server)
+        return results
@@ -1,10 +1,12 @@
 import time
+from collections import defaultdict
 from cacpy.CACPy import *
 import pytest
 import mock
 
 from cloudatcost_ansible_module import cac_server
 from cloudatcost_ansible_module.cac_server import CACServer
+from cloudatcost_ansible_module.stream import TimeoutCACPy
 
 ROOT_URL = BASE_URL + API_VERSION
 
@@ -136,6 +138,7 @@ def mock_cac_api():
     api.key = 'shhverysecret'
     api.get_server_info.return_value = V1_LISTSERVERS_RESPONSE
     api.get_template_info.return_value = V1_LIST_TEMPLATES_RESPONSE
+    api.get_resources.return_value = V1_STANDARD_RESPONSE_OK
     api.rename_server.return_value = V1_STANDARD_RESPONSE_OK
     api.change_hostname.return_value = V1_STANDARD_RESPONSE_OK
     api.set_run_mode.return_value = V1_STANDARD_RESPONSE_OK
@@ -161,11 +164,18 @@ def simulated_build(before=3, build=3):
         yield complete_response
 
 
+def listservers_with_status(status, sid='123456789'):
+    """ A listservers response in which the server with sid has the given status """
+    servers = [dict(server, status=status) if server['sid'] == sid else server
+               for server in V1_LISTSERVERS_RESPONSE['data']]
+    return dict(V1_LISTSERVERS_RESPONSE, data=servers)
+
+
 @pytest.fixture(autouse=True)
 def patch_get_api(monkeypatch):
     api = mock_cac_api()
 
-    def patch_api(api_user, api_key):
+    def patch_api(api_user, api_key, deadline=None, check=True):
         return api
 
     monkeypatch.setattr(cac_server, "get_api", patch_api)
@@ -177,11 +187,28 @@ def patch_sleep(monkeypatch):
     monkeypatch.setattr(time, 'sleep', fakesleep)
 
 
+@pytest.fixture()
+def virtual_clock(monkeypatch):
+    """
+    Replace time.time and time.sleep with a VirtualClock, and the modules' ThreadPools with ones whose threads share
+    it (see tests/virtual_clock.py)
+    """
+    import cac_inv
+    from cloudatcost_ansible_module import cac_rdns, cac_rolling_restart
+    from tests.virtual_clock import VirtualClock, VirtualThreadPool
+    clock = VirtualClock()
+    monkeypatch.setattr(time, 'time', clock.time)
+    monkeypatch.setattr(time, 'sleep', clock.sleep)
+    for module in (cac_server, cac_inv, cac_rdns, cac_rolling_restart):
+        monkeypatch.setattr(module, 'ThreadPool', lambda processes=None: VirtualThreadPool(clock, processes))
+    return clock
+
+
 @pytest.fixture()
 def patch_get_api_simulated_build(monkeypatch):
     api = mock_cac_api()
 
-    def patch_api(api_user, api_key):
+    def patch_api(api_user, api_key, deadline=None, check=True):
         api.get_server_info.side_effect = simulated_build(1)
         return api
 
@@ -213,7 +240,67 @@ def patch_get_server(monkeypatch):
 
 @pytest.fixture()
 def patch_build_server(monkeypatch):
-    def return_mock_server(api, cpus, ram, storage, template, label, wait, wait_timeout):
+    def return_mock_server(api, cpus, ram, storage, template, label, wait, wait_timeout, deadline=None):
         return mock_server(api, '012345678', label, cpus, ram, storage, template)
 
-    monkeypatch.setattr(cac_server.CACServer, 'build_server', return_mock_server)
\ No newline at end of file
+    monkeypatch.setattr(cac_server.CACServer, 'build_server', return_mock_server)
+
+# -- RECORDING TRANSPORT FOR API BUDGET TESTS -- #
+
+class RecordingTransport(object):
+    """
+    Stand-in for CACPy._make_request.  Serves canned responses by endpoint, and records every call made, so tests
+    can assert on the number of round-trips a scenario costs.
+
+    Responses may be a dict, or a callable that is called with the CACPy instance and request options for each call.
+    Set latency to have each call take that many seconds.
+    """
+
+    def __init__(self, responses, latency=0):
+        self.responses = responses
+        self.latency = latency
+        self.calls = []
+
+    def __call__(self, api, endpoint, options=dict(), type="GET"):
+        self.calls.append((endpoint, dict(options)))
+        if self.latency:
+            time.sleep(self.latency)
+        response = self.responses[endpoint]
+        if callable(response):
+            response = response(api, options)
+        return response
+
+    def counts(self):
+        """ Return the number of calls made, keyed by endpoint name (ie. 'listservers', 'cloudpro/build') """
+        counts = defaultdict(int)
+        for (endpoint, options) in self.calls:
+            counts[endpoint.strip('/').replace('.php', '')] += 1
+        return dict(counts)
+
+
+def default_responses():
+    return {
+        LIST_SERVERS_URL: V1_LISTSERVERS_RESPONSE,
+        LIST_TEMPLATES_URL: V1_LIST_TEMPLATES_RESPONSE,
+        RESOURCE_URL: V1_STANDARD_RESPONSE_OK,
+        POWER_OPERATIONS_URL: V1_STANDARD_RESPONSE_OK,
+        RENAME_SERVER_URL: V1_STANDARD_RESPONSE_OK,
+        REVERSE_DNS_URL: V1_STANDARD_RESPONSE_OK,
+        RUN_MODE_URL: V1_STANDARD_RESPONSE_OK,
+        SERVER_BUILD_URL: V1_BUILD_SUCCESS,
+        SERVER_DELETE_URL: V1_DELETE_SUCCESS,
+    }
+
+
+@pytest.fixture()
+def recording_transport(monkeypatch):
+    """ Route every CACPy request through a RecordingTransport, with a clean template cache. """
+    transport = RecordingTransport(default_responses())
+
+    def make_request(self, endpoint, options=dict(), type="GET"):
+        return transport(self, endpoint, options, type)
+
+    monkeypatch.setattr(CACPy, '_make_request', make_request)
+    monkeypatch.setattr(TimeoutCACPy, '_make_request', make_request)
+    monkeypatch.setattr(cac_server.CACTemplate, 'templates', {})
+    return transport
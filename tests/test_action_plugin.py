@@ -0,0 +1,156 @@
+import fcntl
+import imp
+import os
+import stat
+import time
+
+import mock
+import pytest
+
+from cloudatcost_ansible_module import cac_server, snapshot
+from cloudatcost_ansible_module.cac_server import CACTemplate, module_params
+
+action = imp.load_source('cac_server_action', os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                                           'action_plugins', 'cac_server.py'))
+
+BATCH = ['web1', 'db1']
+
+
+def run_task(args, host, check_mode=False, uuid='task-1', environment=None):
+    task = mock.Mock(args=args, _uuid=uuid, action='cac_server', environment=environment)
+    setattr(task, 'async', 0)
+    templar = mock.Mock(template=lambda data: data)
+    plugin = action.ActionModule(task, None, mock.Mock(check_mode=check_mode), None, templar, None)
+    return plugin.run(task_vars=dict(inventory_hostname=host, ansible_play_batch=BATCH))
+
+
+@pytest.fixture()
+def snapshots(tmpdir, monkeypatch):
+    monkeypatch.setenv('CAC_API_USER', 'test@user.com')
+    monkeypatch.setenv('CAC_API_KEY', 'secret')
+    monkeypatch.setattr(snapshot, 'snapshot_dir', lambda: str(tmpdir.join('snapshots')))
+    prefetch = mock.Mock(side_effect=cac_server.prefetch)
+    monkeypatch.setattr(snapshot, 'prefetch', prefetch)
+    CACTemplate.templates = {}
+    return prefetch
+
+
+class TestActionPlugin(object):
+    def test_module_params(self):
+        params = module_params(dict(name='web1', sid='123', wait='yes', state='stopped'))
+        assert params['label'] == 'web1'
+        assert params['server_id'] == 123
+        assert params['wait'] is True
+        assert params['wait_timeout'] == 300
+        pytest.raises(ValueError, module_params, dict(state='exploded'))
+        pytest.raises(ValueError, module_params, dict(colour='blue'))
+
+    def test_batch_shares_one_snapshot(self, snapshots):
+        assert run_task(dict(label='serverlabel'), 'web1')['changed'] is False
+        result = run_task(dict(label='poweredoff', state='stopped'), 'db1')
+        assert result['changed'] is False
+        assert result['server']['sid'] == '000000001'
+        assert snapshots.call_count == 1
+        # listservers rejects bad credentials on its own
+        assert not cac_server.get_api('', '').get_resources.called
+
+        # Another task gets its own snapshot
+        run_task(dict(label='serverlabel'), 'web1', uuid='task-2')
+        assert snapshots.call_count == 2
+
+    def test_change_invalidates_snapshot(self, snapshots):
+        result = run_task(dict(label='poweredoff', state='started'), 'db1')
+        assert result['changed'] is True
+        assert cac_server.get_api('', '').power_on_server.called
+        run_task(dict(label='serverlabel'), 'web1')
+        assert snapshots.call_count == 2
+
+    def test_check_mode_and_failures_are_per_host(self, snapshots):
+        result = run_task(dict(label='poweredoff', state='started'), 'db1', check_mode=True)
+        assert result['changed'] is True
+        assert not cac_server.get_api('', '').power_on_server.called
+
+        cac_server.get_api('', '').power_off_server.return_value = {'status': 'error'}
+        result = run_task(dict(label='serverlabel', state='stopped'), 'web1')
+        assert result['failed'] is True
+        assert 'status' in result['msg']
+        assert 'failed' not in run_task(dict(label='poweredoff'), 'db1', check_mode=True)
+
+    def test_credentials_from_task_environment(self, snapshots, monkeypatch):
+        get_api = mock.Mock(side_effect=cac_server.get_api)
+        monkeypatch.setattr(cac_server, 'get_api', get_api)
+        monkeypatch.delenv('CAC_API_USER')
+        monkeypatch.delenv('CAC_API_KEY')
+        # The task's own entry takes precedence over the inherited ones after it
+        environment = [dict(CAC_API_USER='task@user.com'), dict(CAC_API_USER='play@user.com', CAC_API_KEY='playkey')]
+        assert run_task(dict(label='serverlabel'), 'web1', environment=environment)['changed'] is False
+        assert get_api.call_args[0][:2] == ('task@user.com', 'playkey')
+        assert environment[0] == dict(CAC_API_USER='task@user.com')
+
+        # Arguments take precedence over the environment
+        run_task(dict(label='serverlabel', api_user='arg@user.com', api_key='argkey'), 'web1', environment=environment)
+        assert get_api.call_args[0][:2] == ('arg@user.com', 'argkey')
+
+    def test_runs_module_without_credentials(self, snapshots, monkeypatch):
+        execute_module = mock.Mock(return_value=dict(changed=False))
+        monkeypatch.setattr(action.ActionModule, '_execute_module', execute_module)
+        monkeypatch.delenv('CAC_API_KEY')
+        assert run_task(dict(label='serverlabel'), 'web1') == dict(changed=False)
+        assert execute_module.call_count == 1
+
+        # Or when the module needs its own environment
+        monkeypatch.setenv('CAC_API_KEY', 'secret')
+        run_task(dict(label='serverlabel'), 'web1', environment=dict(CAC_STATUS_BROKER='/tmp/broker.sock'))
+        assert execute_module.call_count == 2
+        assert snapshots.call_count == 0
+
+    def test_snapshot_dir_is_private(self, snapshots, tmpdir):
+        run_task(dict(label='serverlabel'), 'web1')
+        assert stat.S_IMODE(os.stat(str(tmpdir.join('snapshots'))).st_mode) == 0o700
+
+        # A directory others can use is refused
+        directory = tmpdir.join('shared')
+        directory.mkdir()
+        directory.chmod(0o755)
+        with pytest.raises(OSError) as e:
+            snapshot.shared_snapshot(cac_server.get_api('', ''), 'key', str(directory))
+        assert 'Refusing' in str(e.value)
+        assert directory.listdir() == []
+
+        # So is a symlink to a private directory
+        tmpdir.join('link').mksymlinkto(tmpdir.join('snapshots'))
+        pytest.raises(OSError, snapshot.shared_snapshot, cac_server.get_api('', ''), 'key', str(tmpdir.join('link')))
+
+    def test_old_locks_are_only_removed_unheld(self, snapshots, tmpdir):
+        directory = tmpdir.join('snapshots')
+        run_task(dict(label='serverlabel'), 'web1')
+        (held, free) = (directory.join('held.lock'), directory.join('free.lock'))
+        for path in (held, free, directory.join('old')):
+            path.write('')
+            path.setmtime(time.time() - 7200)
+        with open(str(held), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            snapshot._remove_old(str(directory), 3600)
+            assert held.check() and not free.check() and not directory.join('old').check()
+
+    def test_lock_follows_a_replaced_lock_file(self, tmpdir):
+        path = str(tmpdir.join('key.lock'))
+        opened = []
+
+        def open_then_remove(name, mode):
+            # Another process removes the first file opened, and creates a new one, before it is locked
+            f = open(name, mode)
+            if not opened:
+                os.unlink(name)
+                open(name, 'a').close()
+            opened.append(f)
+            return f
+        with mock.patch.object(snapshot, 'open', open_then_remove, create=True):
+            lock = snapshot._lock(path)
+        assert len(opened) == 2 and lock is opened[1]
+        assert os.path.samestat(os.fstat(lock.fileno()), os.stat(path))
+        lock.close()
+
+    def test_snapshot_leaves_no_temporary_files(self, snapshots, tmpdir):
+        run_task(dict(label='serverlabel'), 'web1')
+        assert [name for name in tmpdir.join('snapshots').listdir() if name.basename.startswith('.')] == []
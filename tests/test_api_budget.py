@@ -0,0 +1,92 @@
+"""
+API-call budget regression tests.
+
+Each scenario runs against a RecordingTransport, and the number of calls made to each CloudAtCost endpoint is checked
+against the upper bounds in api_budget.json.  If a change adds round-trips, these tests fail; if a change removes
+them, lower the budget in the same commit so it can't creep back up.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+from cloudatcost_ansible_module import cac_server
+from cloudatcost_ansible_module.cac_server import get_api
+from tests.conftest import simulated_build, V1_LISTSERVERS_RESPONSE
+from tests.test_cloudatcost import set_module_args
+
+with open(os.path.join(os.path.dirname(__file__), 'api_budget.json')) as f:
+    BUDGETS = json.load(f)
+
+
+def assert_within_budget(scenario, transport):
+    budget = BUDGETS[scenario]
+    counts = transport.counts()
+    over = dict((endpoint, (count, budget.get(endpoint, 0))) for (endpoint, count) in counts.items()
+                if count > budget.get(endpoint, 0))
+    assert not over, "Scenario '%s' exceeded its API budget (endpoint: (calls, budget)): %s" % (scenario, over)
+
+
+def run_module(capsys, args):
+    set_module_args(dict(api_user="test@guy.com", api_key="secret", **args))
+    pytest.raises(SystemExit, cac_server.main)
+    out, err = capsys.readouterr()
+    output = json.loads(out)
+    assert not output.get('failed'), output
+    return output
+
+
+@pytest.fixture()
+def real_get_api(monkeypatch):
+    monkeypatch.setattr(cac_server, "get_api", get_api)
+
+
+@pytest.mark.usefixtures('real_get_api')
+class TestModuleBudget(object):
+    def test_converged_server(self, recording_transport, capsys):
+        run_module(capsys, dict(server_id=123456789, state='present'))
+        assert_within_budget('converged', recording_transport)
+
+    def test_rename(self, recording_transport, capsys):
+        run_module(capsys, dict(server_id=123456789, label='renamed', state='present'))
+        assert_within_budget('rename', recording_transport)
+
+    def test_power_change(self, recording_transport, capsys):
+        run_module(capsys, dict(server_id=123456789, state='stopped'))
+        assert_within_budget('power_change', recording_transport)
+
+    def test_delete(self, recording_transport, capsys):
+        run_module(capsys, dict(server_id=123456789, state='absent'))
+        assert_within_budget('delete', recording_transport)
+
+    @pytest.mark.usefixtures('patch_sleep')
+    def test_build_with_wait(self, recording_transport, capsys):
+        builds = simulated_build()
+        recording_transport.responses['/listservers.php'] = lambda api, options: next(builds)
+        run_module(capsys, dict(label='buildtest', cpus=1, ram=1024, storage=10, template=26, wait=True,
+                                wait_timeout=60, state='present'))
+        assert_within_budget('build_with_wait', recording_transport)
+
+
+class TestInventoryBudget(object):
+    def test_list_10k_hosts(self, recording_transport, monkeypatch, capsys):
+        template = V1_LISTSERVERS_RESPONSE['data'][0]
+        servers = []
+        for i in range(10000):
+            server = dict(template)
+            server.update(sid=str(i), id=str(i), label='host%05d' % i, ip='10.%d.%d.%d' % (i >> 16, (i >> 8) & 255,
+                                                                                          i & 255))
+            servers.append(server)
+        recording_transport.responses['/listservers.php'] = dict(V1_LISTSERVERS_RESPONSE, data=servers)
+
+        monkeypatch.setenv('CAC_INI_PATH', '/nonexistent/cac_inv.ini')
+        monkeypatch.setenv('CAC_API_KEY', 'secret')
+        monkeypatch.setenv('CAC_API_USER', 'test@guy.com')
+        monkeypatch.setattr(sys, 'argv', ['cac_inv.py', '--list'])
+        import cac_inv
+        cac_inv.CloudAtCostInventory()
+
+        out, err = capsys.readouterr()
+        assert len(json.loads(out)['_meta']['hostvars']) == 10000
+        assert_within_budget('inventory_list_10k', recording_transport)
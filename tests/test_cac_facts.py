@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from cloudatcost_ansible_module import cac_facts, cac_server
+from tests.test_cloudatcost import set_module_args
+
+
+def run_module(capsys, **args):
+    set_module_args(dict(api_user="test@guy.com", api_key="secret", **args))
+    pytest.raises(SystemExit, cac_facts.main)
+    out, err = capsys.readouterr()
+    return json.loads(out)
+
+
+class TestFactsModule(object):
+    def test_facts_by_label(self, capsys):
+        output = run_module(capsys)
+        facts = output['ansible_facts']['cac_servers']
+        assert output['changed'] is False
+        assert sorted(facts) == ['poweredoff', 'serverlabel']
+        assert facts['serverlabel']['sid'] == '123456789'
+        assert facts['serverlabel']['template'] == 'CentOS-7-64bit'
+        assert facts['serverlabel']['template_id'] == '26'
+
+    def test_facts_by_inventory_hostname(self, capsys):
+        output = run_module(capsys, hosts={'web1': '10.1.1.2', 'poweredoff': 'poweredoff.example',
+                                           'stranger': '192.168.1.1'})
+        hosts = output['ansible_facts']['cac_hosts']
+        assert hosts['web1']['label'] == 'serverlabel'
+        assert hosts['poweredoff']['sid'] == '000000001'
+        assert output['ansible_facts']['cac_unmatched_hosts'] == ['stranger']
+
+    def test_missing_package(self, capsys, monkeypatch):
+        monkeypatch.setattr(cac_facts, 'HAS_CAC_MODULE', False)
+        output = run_module(capsys)
+        assert output['failed'] is True
+        assert output['msg'] == 'cloudatcost_ansible_module package required for this module'
+
+    def test_single_api_read(self, capsys):
+        run_module(capsys, hosts=dict(('host%d' % i, '10.1.1.%d' % i) for i in range(500)))
+        api = cac_server.get_api('', '')
+        assert api.get_server_info.call_count == 1
+        assert not api.get_resources.called
@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+
+import pytest
+from mock import call
+
+from cloudatcost_ansible_module import cac_rdns, cac_server
+from cloudatcost_ansible_module.cac_rdns import parse_zone, plan_changes, apply_changes
+from cloudatcost_ansible_module.cac_server import CACServer, list_servers
+from tests.test_cloudatcost import set_module_args
+
+
+def run_module(capsys, **args):
+    set_module_args(dict(api_user="test@guy.com", api_key="secret", **args))
+    pytest.raises(SystemExit, cac_rdns.main)
+    out, err = capsys.readouterr()
+    return json.loads(out)
+
+
+def cac_servers(api):
+    """ Every server in the account, as CACServers, as cac_rdns.main builds them """
+    return [CACServer(api, server) for server in list_servers(api)]
+
+
+class TestRdns(object):
+    def test_parse_zone(self):
+        names = parse_zone(["; rdns for the fleet",
+                            "web1 web1.example.com.",
+                            "db1.example.com.  IN  A  10.1.1.3  # database",
+                            "4.1.1.10.in-addr.arpa. IN PTR mail.example.com.",
+                            ""])
+        assert names == {'web1': 'web1.example.com', '10.1.1.3': 'db1.example.com', '10.1.1.4': 'mail.example.com'}
+
+    def test_parse_bind_zone(self):
+        zone = """$TTL 3600
+@   IN  SOA ns1.example.com. hostmaster.example.com. (
+            2017021301 ; serial
+            3600 900 604800 300 )
+    IN  NS  ns1.example.com.
+2   IN  PTR web1.example.com.
+3   86400 IN PTR db1
+$ORIGIN example.com.
+mail    IN  A   10.1.1.4
+        IN  MX  10 mail
+"""
+        names = parse_zone(zone.splitlines(), origin='1.1.10.in-addr.arpa.')
+        assert names == {'10.1.1.2': 'web1.example.com', '10.1.1.3': 'db1.1.1.10.in-addr.arpa',
+                         '10.1.1.4': 'mail.example.com'}
+
+    def test_parse_zone_errors(self):
+        # Relative PTR owners need an origin
+        pytest.raises(ValueError, parse_zone, ["4 IN PTR host.example.com."])
+        pytest.raises(ValueError, parse_zone, ["$INCLUDE other.zone"])
+        pytest.raises(ValueError, parse_zone, ["@ IN SOA ns1.example.com. hostmaster.example.com. ( 1"])
+
+    def test_only_differences_are_planned(self, mock_cac_api):
+        servers, unmatched = plan_changes(cac_servers(mock_cac_api),
+                                          {'serverlabel': 'server.test.example', '10.1.1.3': 'new.example',
+                                           'missing': 'missing.example'})
+        assert [server['sid'] for server in servers] == ['000000001']
+        assert unmatched == ['missing']
+
+    def test_parallelism_is_bounded(self, mock_cac_api):
+        servers = cac_servers(mock_cac_api) * 5
+        for (i, server) in enumerate(servers):
+            server._changed_attrs = {'rdns': 'host%d.example' % i}
+        running = [0, 0]
+        lock = threading.Lock()
+
+        def slow_change(new_hostname, server_id):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return {'status': 'ok'}
+
+        mock_cac_api.change_hostname.side_effect = slow_change
+        assert apply_changes(servers, parallelism=3) == {}
+        assert mock_cac_api.change_hostname.call_count == 10
+        assert running[1] == 3
+
+    def test_module_changes_only_differences(self, capsys):
+        output = run_module(capsys, names={'serverlabel': 'server.test.example', 'poweredoff': 'new.example'})
+        assert output['changed'] is True
+        assert output['changes'] == {'000000001': {'label': 'poweredoff', 'before': 'poweredoff.test.example',
+                                                   'after': 'new.example'}}
+        api = cac_server.get_api('', '')
+        assert api.get_server_info.call_count == 1
+        assert not api.get_resources.called
+        assert api.change_hostname.mock_calls == [call(new_hostname='new.example', server_id='000000001')]
+
+    def test_module_results_are_keyed_by_sid(self, capsys):
+        api = cac_server.get_api('', '')
+        api.get_server_info.return_value = dict(api.get_server_info.return_value, data=[
+            dict(server, label='') for server in api.get_server_info.return_value['data']])
+        api.change_hostname.return_value = {'status': 'error'}
+        output = run_module(capsys, names={'10.1.1.2': 'web.example', '10.1.1.3': 'db.example'})
+        assert output['failed'] is True
+        assert sorted(output['changes']) == sorted(output['errors']) == ['000000001', '123456789']
+        assert output['msg'] == 'Failed to set rdns for:  (000000001),  (123456789)'
+
+    def test_module_missing_package(self, capsys, monkeypatch):
+        monkeypatch.setattr(cac_rdns, 'HAS_CAC_MODULE', False)
+        output = run_module(capsys, names={'poweredoff': 'new.example'})
+        assert output['msg'] == 'cloudatcost_ansible_module package required for this module'
+
+    def test_module_check_mode(self, capsys):
+        output = run_module(capsys, names={'poweredoff': 'new.example'}, _ansible_check_mode=True)
+        assert output['changed'] is True
+        assert not cac_server.get_api('', '').change_hostname.called
+
+    def test_module_converged(self, capsys, tmpdir):
+        zone = tmpdir.join('zone')
+        zone.write("serverlabel server.test.example\n10.1.1.3 poweredoff.test.example\n")
+        output = run_module(capsys, zone_file=str(zone))
+        assert output['changed'] is False
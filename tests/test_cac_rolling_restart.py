@@ -0,0 +1,151 @@
+import json
+import socket
+import time
+
+import pytest
+
+from cloudatcost_ansible_module import cac_rolling_restart, cac_server
+from cloudatcost_ansible_module.cac_rolling_restart import select_servers, get_batch_size, rolling_restart
+from cloudatcost_ansible_module.status_broker import StatusBroker
+from tests.conftest import V1_LISTSERVERS_RESPONSE
+from tests.test_cloudatcost import set_module_args
+from tests.virtual_clock import SimulatedCloud, watch
+
+
+def fleet(count):
+    """ count Powered On servers, labelled web0, web1, ... on 127.0.0.1 """
+    template = V1_LISTSERVERS_RESPONSE['data'][0]
+    return [dict(template, sid=str(i), label='web%d' % i, ip='127.0.0.1') for i in range(count)]
+
+
+class RestartingAPI(object):
+    """ Makes each server show as Restarting for a while after reset_server """
+
+    def __init__(self, api, servers, restart_seconds=0.1):
+        self.api = api
+        self.servers = servers
+        self.restart_seconds = restart_seconds
+        self.restarted = {}
+        api.get_server_info.side_effect = self.get_server_info
+        api.reset_server.side_effect = self.reset_server
+
+    def get_server_info(self):
+        now = time.time()
+        servers = [dict(server, status='Restarting' if now - self.restarted.get(server['sid'], 0) <
+                        self.restart_seconds else server['status'])
+                   for server in self.servers]
+        return dict(V1_LISTSERVERS_RESPONSE, data=servers)
+
+    def reset_server(self, server_id):
+        self.restarted[server_id] = time.time()
+        return {'status': 'ok'}
+
+
+@pytest.fixture()
+def cloud(virtual_clock):
+    """ A SimulatedCloud of four servers, Restarting for a minute after a reset, and a StatusBroker for it """
+    cloud = SimulatedCloud(virtual_clock, servers=fleet(4), power_seconds=60)
+    return cloud, StatusBroker(cloud, min_interval=2, max_interval=30, clock=virtual_clock)
+
+
+class TestRollingRestart(object):
+    def test_select_servers(self):
+        servers = V1_LISTSERVERS_RESPONSE['data']
+        assert [s['label'] for s in select_servers(servers, {'label': '*label'})] == ['serverlabel']
+        assert [s['label'] for s in select_servers(servers, {'status': 'Powered*', 'mode': 'Normal'})] == \
+            ['serverlabel', 'poweredoff']
+        assert select_servers(servers, {'label': 'web*'}) == []
+
+    def test_batch_size(self):
+        assert get_batch_size(10) == 1
+        assert get_batch_size(10, batch_size=3) == 3
+        assert get_batch_size(10, max_unavailable='2') == 2
+        assert get_batch_size(10, max_unavailable='25%') == 2
+        assert get_batch_size(3, max_unavailable='10%') == 1
+
+    def test_batches_restart_concurrently(self, cloud, virtual_clock):
+        cloud, watcher = cloud
+        results = watch(virtual_clock, watcher, lambda: rolling_restart(cloud, watcher, fleet(4), 2, wait_timeout=300))
+        assert [batch['servers'] for batch in results] == [['web0', 'web1'], ['web2', 'web3']]
+        assert all(not batch['failed'] for batch in results)
+        # Each batch waits out one restart, not two
+        assert [batch['seconds'] for batch in results] == [64.344, 64.344]
+        # The second batch only starts once the first is back
+        assert [t - virtual_clock.start for (t, call) in cloud.calls if call == 'reset'] == [0, 0, 64.34375, 64.34375]
+
+    def test_failed_batch_stops_the_restart(self, cloud, virtual_clock):
+        cloud, watcher = cloud
+        results = watch(virtual_clock, watcher, lambda: rolling_restart(cloud, watcher, fleet(4), 2, wait_timeout=45))
+        assert len(results) == 1
+        assert results[0]['failed'] == {'0': dict(label='web0', error='Not Powered On after 45s'),
+                                        '1': dict(label='web1', error='Not Powered On after 45s')}
+        assert results[0]['seconds'] == 45
+        assert cloud.count('reset') == 2
+
+    def test_failures_are_keyed_by_sid(self, cloud, virtual_clock):
+        cloud, watcher = cloud
+        # Freshly built servers have no label yet
+        servers = [dict(server, label='') for server in fleet(2)]
+        results = watch(virtual_clock, watcher, lambda: rolling_restart(cloud, watcher, servers, 2, wait_timeout=45))
+        assert results[0]['failed'] == {'0': dict(label='', error='Not Powered On after 45s'),
+                                        '1': dict(label='', error='Not Powered On after 45s')}
+
+    def test_health_check(self, cloud, virtual_clock):
+        cloud, watcher = cloud
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        port = listener.getsockname()[1]
+
+        def restarts():
+            try:
+                accepting = rolling_restart(cloud, watcher, fleet(1), 1, wait_timeout=300, health_check_port=port)
+            finally:
+                listener.close()
+            return accepting, rolling_restart(cloud, watcher, fleet(1), 1, wait_timeout=300, health_check_port=port,
+                                              health_check_timeout=10)
+
+        (accepting, closed) = watch(virtual_clock, watcher, restarts)
+        assert accepting[0]['failed'] == {}
+        assert closed[0]['failed'] == {'0': dict(label='web0',
+                                                 error='Port %s not accepting connections after 10s' % port)}
+        assert closed[0]['seconds'] == 74.344
+
+
+class TestRollingRestartModule(object):
+    def run_module(self, capsys, **args):
+        set_module_args(dict(api_user="test@guy.com", api_key="secret", **args))
+        with pytest.raises(SystemExit):
+            cac_rolling_restart.main()
+        out, err = capsys.readouterr()
+        return json.loads(out)
+
+    def test_check_mode(self, capsys):
+        output = self.run_module(capsys, selector={'label': '*'}, max_unavailable='50%', _ansible_check_mode=True)
+        assert output['changed'] is True
+        assert output['batches'] == [{'servers': ['serverlabel']}, {'servers': ['poweredoff']}]
+        assert not cac_server.get_api('', '').reset_server.called
+        assert not cac_server.get_api('', '').get_resources.called
+
+    def test_missing_package(self, capsys, monkeypatch):
+        monkeypatch.setattr(cac_rolling_restart, 'HAS_CAC_MODULE', False)
+        output = self.run_module(capsys, selector={'label': '*'})
+        assert output['msg'] == 'cloudatcost_ansible_module package required for this module'
+
+    def test_restart(self, capsys):
+        RestartingAPI(cac_server.get_api('', ''), V1_LISTSERVERS_RESPONSE['data'][:1], restart_seconds=0.05)
+        output = self.run_module(capsys, selector={'label': 'serverlabel'}, poll_interval=0.01)
+        assert output['changed'] is True
+        assert [batch['servers'] for batch in output['batches']] == [['serverlabel']]
+        assert output['batches'][0]['seconds'] >= 0.05
+
+    def test_failure_message(self, capsys, monkeypatch):
+        # Both servers share a label
+        failed = {'123456789': dict(label='web', error='Not Powered On after 900s'),
+                  '000000001': dict(label='web', error='Restart failed: error')}
+        monkeypatch.setattr(cac_rolling_restart, 'rolling_restart',
+                            lambda *args: [dict(servers=['web', 'web'], seconds=900, failed=failed)])
+        output = self.run_module(capsys, selector={'label': '*'}, batch_size=2)
+        assert output['failed'] is True
+        assert output['msg'] == "Rolling restart stopped after batch 1.  Failed: web (000000001): Restart failed: " \
+                                "error, web (123456789): Not Powered On after 900s"
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from cloudatcost_ansible_module import cac_server
+from cloudatcost_ansible_module.cac_server import get_api, get_server
+from cloudatcost_ansible_module.cassette import RecordingCACPy, ReplayCACPy, CassetteError, SCRUBBED, cassette_api
+from tests.conftest import V1_LISTSERVERS_RESPONSE, V1_LIST_TEMPLATES_RESPONSE
+
+
+@pytest.fixture()
+def cassette(tmpdir, recording_transport):
+    """ Record a short session against the RecordingTransport, and return the cassette path. """
+    path = str(tmpdir.join('cassette.json'))
+    api = RecordingCACPy('test@user.com', 'shhverysecret', path)
+    api.get_resources()
+    api.get_server_info()
+    api.get_template_info()
+    api.power_off_server(server_id=123456789)
+    return path
+
+
+class TestCassette(object):
+    def test_recording_scrubs_secrets(self, cassette):
+        with open(cassette) as f:
+            recorded = f.read()
+        assert 'shhverysecret' not in recorded
+        assert '"password"' not in recorded
+        servers = json.loads(recorded)['interactions'][1]['response']['data']
+        assert servers[0]['rootpass'] == SCRUBBED
+        assert servers[0]['vncpass'] == SCRUBBED
+        assert servers[0]['ip'] == '10.1.1.2'
+
+    def test_replay_without_network(self, cassette, recording_transport):
+        recording_transport.calls = []
+        api = ReplayCACPy('test@user.com', 'anykey', cassette)
+        assert api.get_server_info()['data'][0]['sid'] == V1_LISTSERVERS_RESPONSE['data'][0]['sid']
+        assert api.get_template_info() == V1_LIST_TEMPLATES_RESPONSE
+        # Recorded as an int, replayed with a string: the same request over HTTP.
+        assert api.power_off_server(server_id='123456789')['status'] == 'ok'
+        assert recording_transport.calls == []
+
+    def test_replay_unrecorded_request_raises(self, cassette):
+        api = ReplayCACPy('test@user.com', 'anykey', cassette)
+        pytest.raises(CassetteError, api.power_on_server, server_id=123456789)
+
+    def test_get_api_replays_from_environment(self, cassette, recording_transport, monkeypatch):
+        recording_transport.calls = []
+        monkeypatch.setenv('CAC_CASSETTE', cassette)
+        monkeypatch.setattr(cac_server, 'get_api', get_api)
+        api = cac_server.get_api('test@user.com', 'anykey')
+        assert isinstance(api, ReplayCACPy)
+        assert get_server(api, server_id=123456789)['label'] == 'serverlabel'
+        assert recording_transport.calls == []
+
+    def test_invalid_mode(self, cassette):
+        pytest.raises(ValueError, cassette_api, 'user', 'key',
+                      {'CAC_CASSETTE': cassette, 'CAC_CASSETTE_MODE': 'rewind'})
@@ -1,13 +1,19 @@
 import pytest
 
-from cloudatcost_ansible_module.cac_server import CACTemplate, get_server, CACServer, CacApiError
-from cloudatcost_ansible_module import cac_server as cac_server
+from cloudatcost_ansible_module.cac_server import CACTemplate, get_server, CACServer, CacApiError, prefetch, \
+    module_params
+from cloudatcost_ansible_module.stream import TimeoutCACPy
+from cloudatcost_ansible_module import cac_server as cac_server, stream
 import json
+import mock
+import time
 from ansible.module_utils import basic
 from ansible.module_utils._text import to_bytes
 from mock import call
 
-from tests.conftest import simulated_build
+from tests.conftest import simulated_build, listservers_with_status, V1_LISTSERVERS_RESPONSE, \
+    V1_LIST_TEMPLATES_RESPONSE, V1_STANDARD_RESPONSE_ERROR
+from tests.test_stream import CountingChunks
 
 
 def set_module_args(args):
@@ -111,6 +117,44 @@ class TestServerClass(object):
         assert call.set_run_mode(run_mode='normal', server_id='123456789') in mock_cac_api.method_calls
         assert call.reset_server(server_id='123456789') in mock_cac_api.method_calls
 
+    def test_independent_changes_are_concurrent(self, mock_cac_api, virtual_clock):
+        calls = []
+
+        def slow(name):
+            def call(**kwargs):
+                calls.append((name, time.time()))
+                time.sleep(0.1)
+                return {'status': 'ok'}
+            return call
+
+        for name in ('rename_server', 'change_hostname', 'set_run_mode', 'power_off_server'):
+            getattr(mock_cac_api, name).side_effect = slow(name)
+        server = get_server(mock_cac_api, 123456789)
+        server['label'] = "testing"
+        server['rdns'] = "server.test.com"
+        server['mode'] = "safe"
+        server['status'] = "Powered Off"
+        assert server.apply_changes() == {'label': 'testing', 'rdns': 'server.test.com', 'mode': 'safe',
+                                          'status': 'Powered Off'}
+        # Two round-trips: label, rdns and mode together, then the power change
+        start = virtual_clock.start
+        assert dict(calls) == {'rename_server': start, 'change_hostname': start, 'set_run_mode': start,
+                               'power_off_server': start + 0.1}
+        assert time.time() == start + 0.2
+
+    def test_failed_change_skips_dependents(self, mock_cac_api):
+        mock_cac_api.set_run_mode.return_value = {'status': 'error', 'error_description': 'nope'}
+        server = get_server(mock_cac_api, 123456789)
+        server['label'] = "testing"
+        server['mode'] = "safe"
+        server['status'] = "Deleted"
+        with pytest.raises(CacApiError) as e:
+            server.apply_changes()
+        assert 'mode: CloudAtCost API call failed' in str(e.value)
+        assert 'status: Not changed, as the mode change failed' in str(e.value)
+        assert call.rename_server(new_name='testing', server_id='123456789') in mock_cac_api.method_calls
+        assert not mock_cac_api.server_delete.called
+
     def test_server_build_failure(self, cac_api_fail_build):
         pytest.raises(CacApiError, CACServer.build_server, api=cac_api_fail_build, cpu=1, ram=1024, disk=10,
                       template=27, label='test')
@@ -132,6 +176,81 @@ class TestServerClass(object):
         assert call.server_build(1, 1024, 10, '27') in mock_cac_api.method_calls
 
 
+    def test_poller_backs_off(self, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(time, 'sleep', sleeps.append)
+        assert cac_server._poller(lambda: None, 30, 2, backoff=1.5, max_interval=6) is None
+        assert sleeps == [2, 3, 4.5, 6, 6, 6, 2.5]
+
+    def test_commit_waits_for_restart(self, mock_cac_api, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(time, 'sleep', sleeps.append)
+        mock_cac_api.get_server_info.side_effect = [listservers_with_status('Powered On'),
+                                                    listservers_with_status('Powered Off'),
+                                                    listservers_with_status('Powered Off'),
+                                                    listservers_with_status('Powered On')]
+        server = get_server(mock_cac_api, server_id='123456789', servers=V1_LISTSERVERS_RESPONSE['data'])
+        server['status'] = 'Restarted'
+        updated = server.commit(wait=True, wait_timeout=60)
+        assert updated['status'] == 'Powered On'
+        assert call.reset_server(server_id='123456789') in mock_cac_api.method_calls
+        # Seen to leave Powered On at the first poll, then back at the second
+        assert sleeps == [2, 2, 3]
+
+    def test_commit_wait_times_out(self, mock_cac_api, monkeypatch):
+        monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+        server = get_server(mock_cac_api, server_id='123456789')
+        server['status'] = 'Powered Off'
+        pytest.raises(CacApiError, server.commit, wait=True, wait_timeout=30)
+        assert call.power_off_server(server_id='123456789') in mock_cac_api.method_calls
+
+    def test_is_converged(self):
+        record = V1_LISTSERVERS_RESPONSE['data'][0]
+        assert cac_server.is_converged(module_params(dict(server_id=123456789)), record)
+        assert cac_server.is_converged(module_params(dict(label='serverlabel', fqdn='server.test.example',
+                                                          runmode='normal')), record)
+        assert cac_server.is_converged(module_params(dict(label='gone', state='absent')), None)
+        assert not cac_server.is_converged(module_params(dict(server_id=123456789, state='stopped')), record)
+        assert not cac_server.is_converged(module_params(dict(server_id=123456789, state='restarted')), record)
+        assert not cac_server.is_converged(module_params(dict(server_id=123456789, runmode='safe')), record)
+        assert not cac_server.is_converged(module_params(dict(label='new')), None)
+
+    def test_prefetch_reads_concurrently(self, recording_transport, virtual_clock):
+        recording_transport.latency = 0.3
+        api = TimeoutCACPy('test@user.com', 'secret')
+        # In a thread on the clock, so the servers read alongside the pool's shares its time
+        (servers,) = virtual_clock.run_concurrently(lambda: prefetch(api))
+        assert time.time() == virtual_clock.start + 0.3
+        assert recording_transport.counts() == {'cloudpro/resources': 1, 'listservers': 1, 'listtemplates': 1}
+        assert get_server(api, label='poweredoff', servers=servers)['sid'] == '000000001'
+        assert recording_transport.counts()['listservers'] == 1
+
+    def test_prefetch_one_server_stops_at_first_match(self, monkeypatch):
+        fleet = dict(V1_LISTSERVERS_RESPONSE, data=V1_LISTSERVERS_RESPONSE['data'] * 1000)
+        chunks = CountingChunks(json.dumps(fleet).encode('utf-8'), size=1024)
+
+        def get(url, params=None, timeout=None, stream=False):
+            response = mock.Mock(encoding='utf-8')
+            if url.endswith('/listservers.php'):
+                response.iter_content.return_value = chunks
+            else:
+                response.json.return_value = V1_LIST_TEMPLATES_RESPONSE
+            return response
+
+        monkeypatch.setattr(stream.requests, 'get', get)
+        monkeypatch.setattr(CACTemplate, 'templates', {})
+        servers = prefetch(TimeoutCACPy('test@user.com', 'secret'), check=False, label='poweredoff')
+        assert [server['sid'] for server in servers] == ['000000001']
+        assert chunks.read < 5
+        assert CACTemplate.templates == V1_LIST_TEMPLATES_RESPONSE['data']
+
+    def test_prefetch_one_server_not_found(self, recording_transport):
+        api = TimeoutCACPy('test@user.com', 'secret')
+        assert prefetch(api, templates=False, server_id=42) == []
+        recording_transport.responses['/listservers.php'] = V1_STANDARD_RESPONSE_ERROR
+        pytest.raises(CacApiError, prefetch, api, templates=False, server_id=42)
+
+
 class TestAnsibleModule(object):
     # This is a bit of a mess.  A lot of work required to mock objects to test building a server, since there are
     # state change dependencies.  Maybe refactor code, to make it easier to simulate?
@@ -181,6 +300,36 @@ class TestAnsibleModule(object):
         api.power_off_server.assert_has_calls(
             [call.power_off_server(server_id='123456789'), ], any_order=True)
 
+    def test_module_converged_fast_path(self, capsys, monkeypatch):
+        monkeypatch.setattr(CACTemplate, 'templates', {})
+        set_module_args(dict(api_user="test@guy.com", api_key="secret", label='serverlabel', runmode='normal',
+                             state='started'))
+        pytest.raises(SystemExit, cac_server.main)
+        out, err = capsys.readouterr()
+        output = json.loads(out)
+        assert output['changed'] is False
+        assert output['server']['sid'] == '123456789'
+        # The listservers record, without templates
+        assert output['server']['template'] == 'CentOS-7-64bit'
+        api = cac_server.get_api('', '')
+        assert api.get_server_info.call_count == 1
+        assert not api.get_template_info.called
+        assert not api.get_resources.called
+
+    def test_module_waits_for_stop(self, capsys, monkeypatch):
+        monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+        api = cac_server.get_api('', '')
+        api.get_server_info.side_effect = lambda: listservers_with_status(
+            'Powered Off' if api.power_off_server.call_count and api.get_server_info.call_count > 3 else 'Powered On')
+        set_module_args(dict(api_user="test@guy.com", api_key="secret", server_id=123456789,
+                             state='stopped', wait=True, wait_timeout=60))
+        pytest.raises(SystemExit, cac_server.main)
+        out, err = capsys.readouterr()
+        output = json.loads(out)
+        assert output['changed'] is True
+        assert output['server']['status'] == 'Powered Off'
+        assert api.get_server_info.call_count == 4
+
     def test_check_mode(self, capsys):
         set_module_args(dict(api_user="test@guy.com", api_key="secret", server_id=123456789,
                              state='stopped', _ansible_check_mode=True))
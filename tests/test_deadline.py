@@ -0,0 +1,92 @@
+import json
+
+import mock
+import pytest
+import requests
+
+from cloudatcost_ansible_module import cac_server, stream
+from cloudatcost_ansible_module.cac_server import get_api
+from cloudatcost_ansible_module.deadline import Deadline, DeadlineExceeded
+from cloudatcost_ansible_module.stream import TimeoutCACPy
+from tests.conftest import V1_STANDARD_RESPONSE_OK
+from tests.test_cloudatcost import set_module_args
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeadline(object):
+    def test_remaining_and_report(self):
+        clock = FakeClock()
+        deadline = Deadline(60, clock=clock)
+        with deadline.phase('connect'):
+            clock.now += 10
+        assert deadline.remaining() == 50
+        with pytest.raises(DeadlineExceeded) as e:
+            with deadline.phase('lookup'):
+                clock.now += 55
+                deadline.remaining()
+        assert str(e.value) == "Deadline of 60s exceeded during lookup. Time spent: connect 10.0s, lookup 55.0s"
+        assert deadline.timings() == {'connect': 10.0, 'lookup': 55.0}
+
+    def test_requests_get_remaining_time_as_timeout(self, monkeypatch):
+        clock = FakeClock()
+        get = mock.Mock()
+        get.return_value.json.return_value = V1_STANDARD_RESPONSE_OK
+        monkeypatch.setattr(stream.requests, 'get', get)
+
+        api = TimeoutCACPy('test@user.com', 'secret', Deadline(30, clock=clock))
+        clock.now += 12
+        api.get_resources()
+        assert get.call_args[1]['timeout'] == 18
+
+    def test_request_timeout_raises_deadline_exceeded(self, monkeypatch):
+        monkeypatch.setattr(stream.requests, 'post', mock.Mock(side_effect=requests.exceptions.ReadTimeout()))
+        api = TimeoutCACPy('test@user.com', 'secret', Deadline(30))
+        pytest.raises(DeadlineExceeded, api.power_on_server, server_id='123456789')
+
+    def test_wait_is_cut_short_by_deadline(self, mock_cac_api, monkeypatch):
+        poller = mock.Mock(return_value=None)
+        monkeypatch.setattr(cac_server, '_poller', poller)
+        clock = FakeClock()
+        deadline = Deadline(100, clock=clock)
+        clock.now += 40
+        cac_server.wait_for_status(mock_cac_api, 'Powered On', 3600, servername='test', deadline=deadline)
+        assert poller.call_args[0][1] == 60
+
+    def test_module_reports_phase(self, capsys, monkeypatch):
+        get = mock.Mock()
+        get.return_value.json.return_value = V1_STANDARD_RESPONSE_OK
+
+        def hung_listservers(url, params=None, timeout=None, stream=False):
+            assert timeout <= 5
+            if url.endswith('listservers.php'):
+                raise requests.exceptions.ReadTimeout()
+            return get(url)
+
+        monkeypatch.setattr(stream.requests, 'get', hung_listservers)
+        monkeypatch.setattr(cac_server, 'get_api', get_api)
+        set_module_args(dict(api_user="test@guy.com", api_key="secret", server_id=123456789, timeout=5))
+        pytest.raises(SystemExit, cac_server.main)
+        output = json.loads(capsys.readouterr()[0])
+        assert output['failed'] is True
+        assert 'exceeded during connect' in output['msg']
+        assert set(output['timings']) == set(['connect'])
+
+    def test_module_reports_deadline_during_change(self, capsys):
+        api = cac_server.get_api('', '')
+        api.rename_server.side_effect = DeadlineExceeded('Deadline of 5s exceeded during commit')
+        set_module_args(dict(api_user="test@guy.com", api_key="secret", server_id=123456789, label='renamed',
+                             fqdn='renamed.test.example', timeout=5))
+        pytest.raises(SystemExit, cac_server.main)
+        output = json.loads(capsys.readouterr()[0])
+        assert output['failed'] is True
+        assert output['msg'] == 'Deadline of 5s exceeded during commit'
+        assert 'commit' in output['timings']
+        # The change made alongside it still ran
+        assert api.change_hostname.called
@@ -0,0 +1,57 @@
+import math
+
+from cloudatcost_ansible_module import fleet_report as report_module
+from cloudatcost_ansible_module.fleet_report import FleetColumns, fleet_report, percentiles, NUMERIC_FIELDS
+from tests.conftest import V1_LISTSERVERS_RESPONSE
+
+
+def server(label, cpu, ram, storage, cpuusage, ramusage, hdusage, template='CentOS-7-64bit', mode='Normal',
+           status='Powered On'):
+    return dict(label=label, cpu=str(cpu), ram=str(ram), storage=str(storage), cpuusage=str(cpuusage),
+                ramusage=str(ramusage), hdusage=str(hdusage), template=template, mode=mode, status=status)
+
+
+class TestFleetReport(object):
+    def test_columns_are_parsed_once(self):
+        columns = FleetColumns(V1_LISTSERVERS_RESPONSE['data'] + [dict(label='new', cpu='', ram=None)])
+        assert list(columns.ram[:2]) == [2048.0, 2048.0]
+        assert math.isnan(columns.ram[2]) and math.isnan(columns.cpuusage[2])
+        assert round(columns.utilization()['ram'][0], 2) == 37.26
+
+    def test_percentiles(self):
+        assert percentiles([float(v) for v in range(1, 101)]) == {'p50': 50.5, 'p90': 90.1, 'p95': 95.05,
+                                                                   'p99': 99.01, 'max': 100.0}
+        assert percentiles([float('nan'), 3.0]) == {'p50': 3.0, 'p90': 3.0, 'p95': 3.0, 'p99': 3.0, 'max': 3.0}
+        assert percentiles([]) is None
+
+    def test_report(self):
+        report = fleet_report([server('idle', 4, 8192, 100, 2, 512, 10),
+                               server('busy', 1, 1024, 10, 95, 512, 5, mode='Safe'),
+                               server('full', 2, 2048, 10, 50, 1024, 9.5, template='Debian-8-64bit'),
+                               server('new', 1, 1024, 10, '', '', '', status='Installing')])
+        assert report['servers'] == 4
+        assert report['over_provisioned'] == ['idle']
+        assert report['under_provisioned'] == ['busy', 'full']
+        assert report['utilization']['cpu']['max'] == 95.0
+        assert report['utilization']['disk']['p50'] == 50.0
+        assert report['totals']['template']['CentOS-7-64bit'] == dict(servers=3, cpu=6.0, ram=10240.0, storage=120.0)
+        assert report['totals']['mode']['Safe']['servers'] == 1
+        assert report['totals']['status'] == {'Powered On': dict(servers=3, cpu=7.0, ram=11264.0, storage=120.0),
+                                              'Installing': dict(servers=1, cpu=1.0, ram=1024.0, storage=10.0)}
+
+    def test_large_fleet(self, monkeypatch):
+        servers = [server('s%d' % i, 1 + i % 8, 1024 * (1 + i % 4), 10 * (1 + i % 10), i % 100, 100 + i % 900,
+                          i % 10, template=('CentOS-7-64bit', 'Debian-8-64bit')[i % 2])
+                   for i in range(50000)]
+        parse, calls = report_module._number, [0]
+
+        def number(value):
+            calls[0] += 1
+            return parse(value)
+
+        monkeypatch.setattr(report_module, '_number', number)
+        report = fleet_report(servers)
+        # Each number is parsed once, however many sections of the report use it
+        assert calls[0] == 50000 * len(NUMERIC_FIELDS)
+        assert report['servers'] == 50000
+        assert report['totals']['template']['Debian-8-64bit']['servers'] == 25000
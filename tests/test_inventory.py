@@ -0,0 +1,283 @@
+import fcntl
+import json
+import os
+import stat
+import sys
+import time
+
+import mock
+import pytest
+
+import cac_inv
+from cloudatcost_ansible_module.fleet_store import FleetStore
+from tests.conftest import V1_LISTSERVERS_RESPONSE
+
+ACCOUNTS_INI = """
+[defaults]
+cache_path = %(cache_path)s
+cache_max_age = %(cache_max_age)s
+%(extra)s
+
+[account:personal]
+api_user = bob@smith.com
+api_key = secret1
+
+[account:work]
+api_user = bob@work.com
+api_key = secret2
+"""
+
+
+def account_servers(api, options):
+    """ Each account has the fixture servers, with labels prefixed by the account's user name """
+    servers = []
+    for server in V1_LISTSERVERS_RESPONSE['data']:
+        server = dict(server)
+        server['label'] = '%s-%s' % (api.email.split('@')[1].split('.')[0], server['label'])
+        servers.append(server)
+    return dict(V1_LISTSERVERS_RESPONSE, data=servers)
+
+
+@pytest.fixture()
+def accounts_ini(tmpdir, monkeypatch):
+    def write(cache_max_age=0, extra=''):
+        path = tmpdir.join('cac_inv.ini')
+        path.write(ACCOUNTS_INI % dict(cache_path=str(tmpdir.join('cache')), cache_max_age=cache_max_age,
+                                       extra=extra))
+        monkeypatch.setenv('CAC_INI_PATH', str(path))
+    return write
+
+
+def run_inventory(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, 'argv', ['cac_inv.py'] + list(args))
+    cac_inv.CloudAtCostInventory()
+    out, err = capsys.readouterr()
+    return json.loads(out)
+
+
+class TestInventory(object):
+    def test_single_account_from_environment(self, recording_transport, monkeypatch, capsys):
+        monkeypatch.setenv('CAC_INI_PATH', '/nonexistent/cac_inv.ini')
+        monkeypatch.setenv('CAC_API_KEY', 'secret')
+        monkeypatch.setenv('CAC_API_USER', 'test@guy.com')
+        inventory = run_inventory(monkeypatch, capsys, '--list')
+        assert sorted(inventory['cloudatcost']) == ['poweredoff', 'serverlabel']
+        assert inventory['_meta']['hostvars']['serverlabel']['ansible_host'] == '10.1.1.2'
+
+    def test_accounts_are_merged_with_groups(self, recording_transport, accounts_ini, monkeypatch, capsys):
+        accounts_ini()
+        recording_transport.responses['/listservers.php'] = account_servers
+        inventory = run_inventory(monkeypatch, capsys, '--list')
+        assert sorted(inventory['cloudatcost']) == ['smith-poweredoff', 'smith-serverlabel',
+                                                    'work-poweredoff', 'work-serverlabel']
+        assert sorted(inventory['cloudatcost_personal']) == ['smith-poweredoff', 'smith-serverlabel']
+        assert sorted(inventory['cloudatcost_work']) == ['work-poweredoff', 'work-serverlabel']
+        assert inventory['_meta']['hostvars']['work-serverlabel']['cloud_account'] == 'work'
+
+    def test_duplicate_labels_resolve_to_first_server(self, recording_transport, accounts_ini, monkeypatch, capsys,
+                                                      tmpdir):
+        recording_transport.responses['/listservers.php'] = lambda api, options: dict(
+            V1_LISTSERVERS_RESPONSE, data=[dict(server, label='twin') for server in V1_LISTSERVERS_RESPONSE['data']])
+        accounts_ini()
+        inventory = run_inventory(monkeypatch, capsys, '--list')
+        assert inventory['_meta']['hostvars']['twin']['cloud_sid'] == '123456789'
+        assert inventory['_meta']['hostvars']['twin']['cloud_account'] == 'personal'
+        assert run_inventory(monkeypatch, capsys, '--host', 'twin')['cloud_sid'] == '123456789'
+
+        accounts_ini(extra='store_path = %s' % tmpdir.join('store', 'fleet.sqlite'))
+        run_inventory(monkeypatch, capsys, '--list')
+        assert run_inventory(monkeypatch, capsys, '--host', 'twin')['cloud_sid'] == '123456789'
+
+    def test_accounts_are_fetched_concurrently(self, recording_transport, accounts_ini, virtual_clock, monkeypatch,
+                                               capsys):
+        accounts_ini()
+        recording_transport.responses['/listservers.php'] = account_servers
+        recording_transport.latency = 0.5
+        run_inventory(monkeypatch, capsys, '--list')
+        assert virtual_clock.elapsed() == 0.5
+        assert len(recording_transport.calls) == 2
+
+    def test_accounts_are_cached(self, recording_transport, accounts_ini, monkeypatch, capsys):
+        accounts_ini(cache_max_age=300)
+        recording_transport.responses['/listservers.php'] = account_servers
+        first = run_inventory(monkeypatch, capsys, '--list')
+        assert len(recording_transport.calls) == 2
+
+        assert run_inventory(monkeypatch, capsys, '--list') == first
+        assert len(recording_transport.calls) == 2
+
+        run_inventory(monkeypatch, capsys, '--list', '--refresh-cache')
+        assert len(recording_transport.calls) == 4
+
+    def test_cache_is_private(self, recording_transport, accounts_ini, monkeypatch, capsys, tmpdir):
+        accounts_ini(cache_max_age=300)
+        old_umask = os.umask(0o022)
+        try:
+            run_inventory(monkeypatch, capsys, '--list')
+        finally:
+            os.umask(old_umask)
+        cache_files = tmpdir.join('cache').listdir()
+        assert sorted(f.basename for f in cache_files) == ['ansible-cloudatcost-personal.cache',
+                                                           'ansible-cloudatcost-work.cache']
+        assert all(stat.S_IMODE(f.stat().mode) == 0o600 for f in cache_files)
+
+    def test_hostvars_include_and_exclude(self, recording_transport, accounts_ini, monkeypatch, capsys):
+        recording_transport.responses['/listservers.php'] = account_servers
+        accounts_ini(extra='hostvars_include = sid, label, rootpass, ip\nhostvars_exclude = rootpass')
+        hostvars = run_inventory(monkeypatch, capsys, '--list')['_meta']['hostvars']['smith-serverlabel']
+        assert sorted(hostvars) == ['ansible_host', 'ansible_ssh_host', 'cloud_ip', 'cloud_label', 'cloud_sid']
+
+    def test_hostvars_minimal(self, recording_transport, accounts_ini, monkeypatch, capsys):
+        recording_transport.responses['/listservers.php'] = account_servers
+        accounts_ini()
+        monkeypatch.setattr(sys, 'argv', ['cac_inv.py', '--list'])
+        cac_inv.CloudAtCostInventory()
+        full, err = capsys.readouterr()
+
+        accounts_ini(extra='hostvars_minimal = yes')
+        monkeypatch.setattr(sys, 'argv', ['cac_inv.py', '--list'])
+        cac_inv.CloudAtCostInventory()
+        minimal, err = capsys.readouterr()
+
+        hostvars = json.loads(minimal)['_meta']['hostvars']['work-serverlabel']
+        assert hostvars == {'ansible_host': '10.1.1.2', 'cloud_sid': '123456789', 'cloud_label': 'work-serverlabel',
+                            'cloud_status': 'Powered On', 'cloud_account': 'work'}
+        assert len(minimal) < len(full) / 4
+
+    def test_report(self, recording_transport, accounts_ini, monkeypatch, capsys):
+        accounts_ini()
+        recording_transport.responses['/listservers.php'] = account_servers
+        report = run_inventory(monkeypatch, capsys, '--report')
+        assert report['servers'] == 4
+        assert report['totals']['status']['Powered Off']['servers'] == 2
+
+        monkeypatch.setattr(sys, 'argv', ['cac_inv.py', '--report', '--report-format', 'csv'])
+        cac_inv.CloudAtCostInventory()
+        out, err = capsys.readouterr()
+        rows = out.splitlines()
+        assert rows[0] == 'section,group,name,value'
+        assert 'servers,,count,4' in rows
+        assert 'totals,template=CentOS-7-64bit,ram,8192.0' in rows
+
+
+class TestStaleWhileRevalidate(object):
+    @pytest.fixture()
+    def stale_cache(self, recording_transport, accounts_ini, monkeypatch, capsys, tmpdir):
+        accounts_ini(cache_max_age=300, extra='stale_while_revalidate = 3600')
+        recording_transport.responses['/listservers.php'] = account_servers
+        first = run_inventory(monkeypatch, capsys, '--list')
+        assert len(recording_transport.calls) == 2
+
+        def age(seconds):
+            for cache_file in tmpdir.join('cache').listdir('*.cache'):
+                cache_file.setmtime(time.time() - seconds)
+
+        popen = mock.Mock()
+        monkeypatch.setattr(cac_inv.subprocess, 'Popen', popen)
+        return first, age, popen
+
+    def test_stale_cache_is_served_and_refreshed_in_background(self, stale_cache, recording_transport, monkeypatch,
+                                                               capsys):
+        first, age, popen = stale_cache
+        age(400)
+        assert run_inventory(monkeypatch, capsys, '--list') == first
+        assert len(recording_transport.calls) == 2
+        assert popen.call_args[0][0][-2:] == ['--list', '--revalidate']
+
+    def test_expired_cache_is_refreshed_at_once(self, stale_cache, recording_transport, monkeypatch, capsys):
+        first, age, popen = stale_cache
+        age(4000)
+        run_inventory(monkeypatch, capsys, '--list')
+        assert len(recording_transport.calls) == 4
+        assert not popen.called
+
+    def test_one_refresh_at_a_time(self, stale_cache, recording_transport, monkeypatch, capsys, tmpdir):
+        first, age, popen = stale_cache
+        age(400)
+        with open(str(tmpdir.join('cache', 'ansible-cloudatcost-refresh.lock')), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            assert run_inventory(monkeypatch, capsys, '--list') == first
+            assert not popen.called
+
+            monkeypatch.setattr(sys, 'argv', ['cac_inv.py', '--list', '--revalidate'])
+            cac_inv.CloudAtCostInventory()
+            assert len(recording_transport.calls) == 2
+
+    def test_revalidate_refreshes_cache(self, stale_cache, recording_transport, monkeypatch, capsys):
+        first, age, popen = stale_cache
+        age(400)
+        monkeypatch.setattr(sys, 'argv', ['cac_inv.py', '--list', '--revalidate'])
+        cac_inv.CloudAtCostInventory()
+        out, err = capsys.readouterr()
+        assert out == ''
+        assert len(recording_transport.calls) == 4
+
+        # The refreshed cache is fresh again
+        assert run_inventory(monkeypatch, capsys, '--list') == first
+        assert len(recording_transport.calls) == 4
+        assert not popen.called
+
+    def test_revalidate_skips_fresh_cache(self, stale_cache, recording_transport, monkeypatch, capsys):
+        first, age, popen = stale_cache
+        age(400)
+        assert run_inventory(monkeypatch, capsys, '--list') == first
+        assert popen.call_count == 1
+
+        # Another refresh finished before this one took the lock
+        age(10)
+        monkeypatch.setattr(sys, 'argv', ['cac_inv.py', '--list', '--revalidate'])
+        cac_inv.CloudAtCostInventory()
+        assert len(recording_transport.calls) == 2
+
+
+class TestFleetStore(object):
+    def test_refresh_and_query(self, tmpdir):
+        now = [1000.0]
+        store = FleetStore(str(tmpdir.join('fleet.sqlite')), clock=lambda: now[0])
+        assert store.age('default') is None
+
+        store.refresh('default', V1_LISTSERVERS_RESPONSE['data'])
+        now[0] += 30
+        assert store.age('default') == 30
+        assert [s['sid'] for s in store.query(status='Powered Off')] == ['000000001']
+        assert [s['sid'] for s in store.query(template='CentOS-7-64bit', ip='10.1.1.2')] == ['123456789']
+        assert store.get('serverlabel')['ip'] == '10.1.1.2'
+
+        store.refresh('default', V1_LISTSERVERS_RESPONSE['data'][:1])
+        assert len(store.servers('default')) == 1
+        pytest.raises(KeyError, store.query, rootpass='password')
+
+    def test_store_is_private(self, tmpdir):
+        path = tmpdir.join('fleet.sqlite')
+        path.write('')
+        path.chmod(0o644)
+        FleetStore(str(path)).refresh('default', V1_LISTSERVERS_RESPONSE['data'])
+        assert stat.S_IMODE(path.stat().mode) == 0o600
+
+    def test_host_and_query_are_served_from_store(self, recording_transport, accounts_ini, monkeypatch, capsys,
+                                                  tmpdir):
+        accounts_ini(extra='store_path = %s' % tmpdir.join('store', 'fleet.sqlite'))
+        recording_transport.responses['/listservers.php'] = account_servers
+        old_umask = os.umask(0o022)
+        try:
+            run_inventory(monkeypatch, capsys, '--list')
+        finally:
+            os.umask(old_umask)
+        assert len(recording_transport.calls) == 2
+
+        assert stat.S_IMODE(tmpdir.join('store').stat().mode) == 0o700
+        assert stat.S_IMODE(tmpdir.join('store', 'fleet.sqlite').stat().mode) == 0o600
+
+        host = run_inventory(monkeypatch, capsys, '--host', 'work-poweredoff')
+        assert host['cloud_sid'] == '000000001'
+        assert host['cloud_account'] == 'work'
+
+        servers = run_inventory(monkeypatch, capsys, '--query', 'status=Powered Off,account=personal')
+        assert [server['label'] for server in servers] == ['smith-poweredoff']
+        assert len(recording_transport.calls) == 2
+
+    def test_query_without_store(self, recording_transport, accounts_ini, monkeypatch, capsys):
+        accounts_ini()
+        recording_transport.responses['/listservers.php'] = account_servers
+        servers = run_inventory(monkeypatch, capsys, '--query', 'ip=10.1.1.3')
+        assert sorted(server['label'] for server in servers) == ['smith-poweredoff', 'work-poweredoff']
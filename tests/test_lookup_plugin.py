@@ -0,0 +1,58 @@
+import imp
+import os
+
+import pytest
+from ansible.errors import AnsibleError
+
+from cloudatcost_ansible_module import cac_server, snapshot
+from cloudatcost_ansible_module.snapshot import SnapshotIndex
+from tests.conftest import V1_LISTSERVERS_RESPONSE
+
+lookup = imp.load_source('cac_server_lookup', os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                                           'lookup_plugins', 'cac_server.py'))
+
+
+@pytest.fixture()
+def plugin(tmpdir, monkeypatch):
+    monkeypatch.setattr(snapshot, 'snapshot_dir', lambda: str(tmpdir.join('snapshots')))
+    monkeypatch.setattr(lookup, '_indexes', {})
+    return lookup.LookupModule()
+
+
+class TestLookupPlugin(object):
+    def test_index(self):
+        index = SnapshotIndex(V1_LISTSERVERS_RESPONSE['data'])
+        assert [s['sid'] for s in index.find(status='Powered Off')] == ['000000001']
+        assert [s['sid'] for s in index.find(template='CentOS-7-64bit', ip='10.1.1.2')] == ['123456789']
+        assert index.find(label='missing') == []
+        assert sorted(index.indexes) == ['ip', 'label', 'status']
+
+    def test_parse_term(self):
+        assert lookup.parse_term('web1') == {'label': 'web1'}
+        assert lookup.parse_term('status=Installing, template=CentOS-7-64bit') == \
+            {'status': 'Installing', 'template': 'CentOS-7-64bit'}
+
+    def test_lookups_share_one_read(self, plugin):
+        api = cac_server.get_api('', '')
+        for i in range(1000):
+            assert plugin.run(['label=serverlabel'], attr='ip') == ['10.1.1.2']
+        assert plugin.run(['poweredoff'])[0]['sid'] == '000000001'
+        assert plugin.run(['status=Powered On', 'status=Powered Off'], attr='label') == ['serverlabel', 'poweredoff']
+        assert plugin.run(['label=missing'], attr='ip') == []
+        assert api.get_server_info.call_count == 1
+        assert not api.get_template_info.called
+        assert not api.get_resources.called
+
+        # Another worker process of the same run reads the shared snapshot
+        lookup._indexes.clear()
+        assert plugin.run(['serverlabel'], attr='sid') == ['123456789']
+        assert api.get_server_info.call_count == 1
+
+    def test_refresh(self, plugin):
+        plugin.run(['serverlabel'])
+        plugin.run(['serverlabel'], refresh=True)
+        assert cac_server.get_api('', '').get_server_info.call_count == 2
+
+    def test_api_errors(self, plugin):
+        cac_server.get_api('', '').get_server_info.return_value = {'status': 'error'}
+        pytest.raises(AnsibleError, plugin.run, ['serverlabel'])
@@ -0,0 +1,139 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from cloudatcost_ansible_module import status_broker
+from cloudatcost_ansible_module.cac_server import CACServer
+from cloudatcost_ansible_module.status_broker import StatusBroker, BrokerServer
+from tests.conftest import mock_cac_api, simulated_build, V1_LISTSERVERS_RESPONSE_POST_BUILD
+from tests.virtual_clock import SimulatedCloud, watch
+
+NEW_SERVER = 'c012345678-cloudpro-012345678'
+
+
+@pytest.fixture()
+def broker():
+    api = mock_cac_api()
+    api.get_server_info.side_effect = simulated_build(3, 3)
+    broker = StatusBroker(api, min_interval=0.01, max_interval=0.05)
+    poller = threading.Thread(target=broker.run)
+    poller.daemon = True
+    poller.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture()
+def cloud(virtual_clock):
+    """ A SimulatedCloud building a server for 10 minutes, and a StatusBroker for it, on the virtual clock """
+    cloud = SimulatedCloud(virtual_clock, build_seconds=[600, 900])
+    servername = cloud.server_build(1, 1024, 10, 26)['servername']
+    return cloud, StatusBroker(cloud, min_interval=2, max_interval=60, clock=virtual_clock), servername
+
+
+@pytest.fixture()
+def broker_socket(tmpdir, broker):
+    path = str(tmpdir.join('broker.sock'))
+    server = BrokerServer(path, broker)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+class TestStatusBroker(object):
+    def test_wait_for_build(self, cloud, virtual_clock):
+        cloud, broker, servername = cloud
+        server = watch(virtual_clock, broker, lambda: broker.wait_for_status('Powered On', servername=servername,
+                                                                               timeout=3600))
+        assert server['sid'] == '200000000'
+        # Polls back off while the build runs: 2, 3, 4.5 ... 60s apart
+        assert virtual_clock.elapsed() == 629.7734375
+        assert len([t for (t, call) in cloud.calls if call == 'listservers' and t > virtual_clock.start]) == 17
+
+    def test_wait_timeout(self, cloud, virtual_clock):
+        cloud, broker, servername = cloud
+        assert watch(virtual_clock, broker, lambda: broker.wait_for_status('Powered Off', sid='123456789',
+                                                                             timeout=300)) is None
+        assert virtual_clock.elapsed() == 300
+
+    def test_wait_since_ignores_earlier_polls(self, cloud, virtual_clock):
+        cloud, broker, servername = cloud
+
+        def waits():
+            assert broker.wait_for_status('Powered On', sid='123456789', timeout=5)
+            since = broker.polled + 1
+            assert broker.wait_for_status('Powered On', sid='123456789', timeout=1.5, since=since) is None
+            # A new waiter gets a new poll
+            return broker.wait_for_status('Powered On', sid='123456789', timeout=1.5, since=since)
+        assert watch(virtual_clock, broker, waits)
+        assert virtual_clock.elapsed() == 1.5
+
+    def test_concurrent_waiters_share_polls(self, cloud, virtual_clock):
+        cloud, broker, servername = cloud
+        other = cloud.server_build(1, 1024, 10, 26)['servername']
+
+        def waiter(name, timeout):
+            def wait():
+                server = broker.wait_for_status('Powered On', servername=name, timeout=timeout)
+                return server and virtual_clock.elapsed()
+            return wait
+
+        def waiters():
+            return virtual_clock.run_concurrently(waiter(servername, 3600), waiter(other, 3600), waiter(other, 60))
+        (first, second, timed_out) = watch(virtual_clock, broker, waiters)
+        assert (first, second, timed_out) == (629.7734375, 959.546875, None)
+        # One poller answers all three waiters, backing off as for one
+        assert len([t for (t, call) in cloud.calls if call == 'listservers' and t > virtual_clock.start]) == 29
+
+    def test_idles_without_waiters(self, cloud, virtual_clock):
+        cloud, broker, servername = cloud
+
+        def idle_then_wait():
+            time.sleep(590)
+            return broker.wait_for_status('Powered On', servername=servername, timeout=60)
+        assert watch(virtual_clock, broker, idle_then_wait)
+        # Every 60s with nobody waiting, then at once, and 2s later, for the waiter
+        assert [t - virtual_clock.start for (t, call) in cloud.calls if call == 'listservers'] == \
+            [0, 60, 120, 180, 240, 300, 360, 420, 480, 540, 590, 592, 595, 599.5, 606.25]
+
+    def test_wait_to_leave_status(self, broker_socket):
+        server = status_broker.wait_for_status(broker_socket, 'Installing', servername=NEW_SERVER, timeout=5,
+                                               leave=True)
+        assert server['status'] == 'Powered On'
+
+    def test_socket_client(self, broker_socket):
+        server = status_broker.wait_for_status(broker_socket, 'Powered On', servername=NEW_SERVER, timeout=5)
+        assert server['sid'] == '012345678'
+        assert status_broker.wait_for_status(broker_socket, 'Powered Off', sid='123456789', timeout=0.1) is None
+
+    def test_replaces_only_a_socket(self, broker_socket, broker, tmpdir):
+        # A left-over socket (ie. from a broker that was killed) is replaced
+        server = BrokerServer(broker_socket, broker)
+        server.server_close()
+
+        path = tmpdir.join('not-a-socket')
+        path.write('data')
+        pytest.raises(socket.error, BrokerServer, str(path), broker)
+        assert path.read() == 'data'
+
+    def test_build_waits_on_broker(self, broker_socket, mock_cac_api, monkeypatch):
+        monkeypatch.setenv('CAC_STATUS_BROKER', broker_socket)
+        mock_cac_api.get_server_info.return_value = V1_LISTSERVERS_RESPONSE_POST_BUILD
+        server, response = CACServer.build_server(mock_cac_api, cpu=1, ram=1024, disk=10, template=27,
+                                                  label='test', wait=True, wait_timeout=5)
+        assert server['sid'] == '012345678'
+        # The module only lists servers to commit the label; the broker did the waiting.
+        assert mock_cac_api.get_server_info.call_count == 2
+
+    @pytest.mark.usefixtures('patch_sleep')
+    def test_build_polls_without_broker(self, tmpdir, mock_cac_api, monkeypatch):
+        monkeypatch.setenv('CAC_STATUS_BROKER', str(tmpdir.join('missing.sock')))
+        mock_cac_api.get_server_info.side_effect = simulated_build()
+        server, response = CACServer.build_server(mock_cac_api, cpu=1, ram=1024, disk=10, template=27,
+                                                  label='test', wait=True, wait_timeout=30)
+        assert server
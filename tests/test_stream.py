@@ -0,0 +1,82 @@
+import json
+
+import mock
+import pytest
+
+from cloudatcost_ansible_module import stream
+from cloudatcost_ansible_module.cac_server import get_server, CacApiError
+from cloudatcost_ansible_module.stream import iter_records, iter_server_info
+from cacpy import CACPy
+from tests.conftest import V1_LISTSERVERS_RESPONSE, V1_STANDARD_RESPONSE_ERROR
+
+
+def chunked(text, size=7):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class CountingChunks(object):
+    def __init__(self, text, size=7):
+        self.chunks = chunked(text, size)
+        self.read = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.read += 1
+        return next(self.chunks)
+
+    __next__ = next
+
+
+class TestStream(object):
+    def test_records_match_full_parse(self):
+        text = json.dumps(V1_LISTSERVERS_RESPONSE, indent=2)
+        header = {}
+        assert list(iter_records(chunked(text), header=header)) == V1_LISTSERVERS_RESPONSE['data']
+        assert header['status'] == 'ok'
+        assert header['time'] == 1487000464
+
+    def test_projection(self):
+        records = list(iter_records(chunked(json.dumps(V1_LISTSERVERS_RESPONSE)), fields=('sid', 'label')))
+        assert records == [{'sid': '123456789', 'label': 'serverlabel'}, {'sid': '000000001', 'label': 'poweredoff'}]
+
+    def test_numbers_split_across_chunks(self):
+        header = {}
+        records = list(iter_records(['{"time": 14870', '00464, "data": [{"cpu": 1', '6}], "status": "ok"}'],
+                                    header=header))
+        assert records == [{'cpu': 16}]
+        assert header == {'time': 1487000464, 'status': 'ok'}
+
+    def test_error_response(self):
+        header = {}
+        assert list(iter_records(chunked(json.dumps(V1_STANDARD_RESPONSE_ERROR)), header=header)) == []
+        assert header['status'] == 'error'
+
+    def test_stops_reading_early(self):
+        response = dict(V1_LISTSERVERS_RESPONSE, data=V1_LISTSERVERS_RESPONSE['data'] * 100)
+        chunks = CountingChunks(json.dumps(response), size=1024)
+        next(iter_records(chunks))
+        assert chunks.read < 5
+
+    def test_plain_cacpy_streams_over_http(self, monkeypatch):
+        http_response = mock.Mock(encoding='utf-8')
+        http_response.iter_content.return_value = chunked(json.dumps(V1_LISTSERVERS_RESPONSE).encode('utf-8'))
+        get = mock.Mock(return_value=http_response)
+        monkeypatch.setattr(stream.requests, 'get', get)
+
+        records = list(iter_server_info(CACPy('test@user.com', 'secret'), fields=('sid',)))
+        assert records == [{'sid': '123456789'}, {'sid': '000000001'}]
+        assert get.call_args[1]['stream'] is True
+        assert http_response.close.called
+
+    def test_get_server_checks_status(self, mock_cac_api):
+        mock_cac_api.get_server_info.return_value = V1_STANDARD_RESPONSE_ERROR
+        pytest.raises(CacApiError, get_server, mock_cac_api, server_id=123456789)
+
+    def test_get_server_projection(self, mock_cac_api):
+        server = get_server(mock_cac_api, label='poweredoff', fields=('status',))
+        assert dict(server) == {'sid': '000000001', 'servername': 'c000000001-cloudpro-000000001',
+                                'label': 'poweredoff', 'status': 'Powered Off'}
+        assert not mock_cac_api.get_template_info.called
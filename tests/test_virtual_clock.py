@@ -0,0 +1,141 @@
+import time
+
+from cloudatcost_ansible_module.cac_server import CACServer, get_server, RESTART_GRACE
+from cloudatcost_ansible_module.deadline import Deadline
+from tests.virtual_clock import SimulatedCloud, VirtualThreadPool
+
+HOUR = 3600
+
+
+def build(cloud, label, wait_timeout, deadline=None):
+    server, response = CACServer.build_server(cloud, cpu=1, ram=1024, disk=10, template=26, label=label, wait=True,
+                                              wait_timeout=wait_timeout, deadline=deadline)
+    return server
+
+
+class TestVirtualClock(object):
+    def test_sleep_advances_time(self, virtual_clock):
+        time.sleep(2.5)
+        assert time.time() == virtual_clock.start + 2.5
+
+    def test_concurrent_sleepers_share_time(self, virtual_clock):
+        def sleeper(*seconds):
+            def f():
+                for s in seconds:
+                    time.sleep(s)
+                return virtual_clock.elapsed()
+            return f
+
+        assert virtual_clock.run_concurrently(sleeper(5), sleeper(3, 3), sleeper(1, 1, 1, 1)) == [5, 6, 4]
+        assert virtual_clock.elapsed() == 6
+
+    def test_thread_pool_runs_processes_at_a_time(self, virtual_clock):
+        def nap(seconds):
+            time.sleep(seconds)
+            return virtual_clock.elapsed()
+
+        assert VirtualThreadPool(virtual_clock, 2).map(nap, [5, 3, 3]) == [5, 3, 6]
+        assert virtual_clock.elapsed() == 6
+
+    def test_nested_threads_share_time(self, virtual_clock):
+        def batch():
+            return VirtualThreadPool(virtual_clock, 2).map(time.sleep, [5, 5]) and virtual_clock.elapsed()
+
+        def alongside():
+            time.sleep(4)
+            return virtual_clock.elapsed()
+
+        assert virtual_clock.run_concurrently(batch, alongside) == [5, 4]
+
+    def test_condition_wakes_on_notify_or_timeout(self, virtual_clock):
+        condition = virtual_clock.condition()
+
+        def waiter(timeout):
+            def wait():
+                with condition:
+                    condition.wait(timeout)
+                return virtual_clock.elapsed()
+            return wait
+
+        def notifier():
+            time.sleep(3)
+            with condition:
+                condition.notify_all()
+
+        assert virtual_clock.run_concurrently(waiter(10), waiter(2), notifier) == [3, 2, None]
+
+
+class TestSimulatedScenarios(object):
+    def test_three_hour_build(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, build_seconds=3 * HOUR)
+        server = build(cloud, 'slowbuild', 4 * HOUR)
+        assert server['label'] == 'slowbuild'
+        assert server['status'] == 'Powered On'
+        # Polled every 10s until the build completed, then the label was committed
+        assert virtual_clock.elapsed() == 3 * HOUR
+        assert cloud.count('listservers') == 3 * HOUR / 10 + 2
+
+    def test_build_wait_times_out(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, build_seconds=5 * HOUR)
+        assert build(cloud, 'slowbuild', 4 * HOUR) is None
+        assert virtual_clock.elapsed() == 4 * HOUR
+
+    def test_deadline_cuts_build_wait_short(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, build_seconds=5 * HOUR)
+        assert build(cloud, 'slowbuild', 4 * HOUR, deadline=Deadline(HOUR + 60)) is None
+        assert virtual_clock.elapsed() == HOUR + 60
+
+    def test_concurrent_builds(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, build_seconds=[HOUR, 2 * HOUR, 3 * HOUR])
+
+        def builder(label):
+            def f():
+                build(cloud, label, 4 * HOUR)
+                return virtual_clock.elapsed()
+            return f
+
+        finished = virtual_clock.run_concurrently(builder('web1'), builder('web2'), builder('web3'))
+        assert sorted(finished) == [HOUR, 2 * HOUR, 3 * HOUR]
+        assert sorted(s['label'] for s in cloud.servers.values() if s['status'] == 'Powered On') == \
+            ['serverlabel', 'web1', 'web2', 'web3']
+
+    def test_restart_wait_backs_off(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, power_seconds=45)
+        server = get_server(cloud, server_id='123456789')
+        server['status'] = 'Restarted'
+        server = server.commit(wait=True, wait_timeout=300)
+        assert server['status'] == 'Powered On'
+        # Restarting at the first poll, after 2 seconds.  Then polls 2, 5, 9.5, 16.25, 26.25, 36.25 and 46.25 seconds
+        # after that.
+        assert virtual_clock.elapsed() == 48.25
+        assert [t - virtual_clock.start for (t, call) in cloud.calls if call == 'listservers'][-2:] == [38.25, 48.25]
+
+    def test_restart_wait_ignores_powered_on_before_the_reset_shows(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, power_seconds=20, restart_delay=7)
+        server = get_server(cloud, server_id='123456789')
+        server['status'] = 'Restarted'
+        server = server.commit(wait=True, wait_timeout=300)
+        assert server['status'] == 'Powered On'
+        # Still Powered On at 2, 4 and 6 seconds, Restarting at 8, and back at 27
+        assert virtual_clock.elapsed() == 8 + 26.25
+
+    def test_restart_that_never_shows_waits_out_the_grace_period(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, power_seconds=0)
+        server = get_server(cloud, server_id='123456789')
+        server['status'] = 'Restarted'
+        server = server.commit(wait=True, wait_timeout=300)
+        assert server['status'] == 'Powered On'
+        assert virtual_clock.elapsed() == RESTART_GRACE + 2
+
+    def test_stop_then_start(self, virtual_clock):
+        cloud = SimulatedCloud(virtual_clock, power_seconds=20)
+        server = get_server(cloud, server_id='123456789')
+        server['status'] = 'Powered Off'
+        server = server.commit(wait=True, wait_timeout=300)
+        assert server['status'] == 'Powered Off'
+        assert virtual_clock.elapsed() == 26.25
+
+        server['status'] = 'Powered On'
+        server = server.commit(wait=True, wait_timeout=300)
+        assert server['status'] == 'Powered On'
+        assert virtual_clock.elapsed() == 52.5
@@ -0,0 +1,325 @@
+"""
+A deterministic virtual clock, and a stand-in CloudAtCost API whose servers change status over virtual time.
+
+With the virtual_clock fixture patched in, time.sleep returns at once after advancing time.time, and the modules'
+ThreadPools start their threads on the clock, so _poller, wait_for_status, build_server, Deadline, StatusBroker (given
+the clock) and SimulatedCloud all share one timeline.  Hour-long builds run in milliseconds, and elapsed times can be
+asserted exactly.
+"""
+import threading
+
+from cacpy import CACPy
+
+from tests.conftest import V1_LISTSERVERS_RESPONSE, V1_LIST_TEMPLATES_RESPONSE, V1_STANDARD_RESPONSE_OK, \
+    V1_DELETE_SUCCESS
+
+
+class VirtualClock(object):
+    """
+    Stand-in for time.time and time.sleep.
+
+    Outside of the threads it starts (with spawn(), run_concurrently() or a VirtualThreadPool), sleep() advances the
+    time at once.  The threads it starts sleep together: the time only advances, to the earliest wake-up, once every
+    one of them is sleeping, waiting on a condition() or done.  A thread waiting for the threads it started doesn't
+    hold the time up.
+    """
+
+    def __init__(self, start=1000000.0):
+        self.start = start
+        self.now = start
+        self._cond = threading.Condition()
+        self._participants = set()
+        # Participants in sleep() or a condition's wait(), and the time each wakes at (None: only once notified)
+        self._blocked = {}
+
+    def time(self):
+        return self.now
+
+    def elapsed(self):
+        return self.now - self.start
+
+    def sleep(self, seconds):
+        with self._cond:
+            wake = self.now + seconds
+            if threading.current_thread() not in self._participants:
+                self.now = max(self.now, wake)
+                return
+            self._block(wake)
+
+    def condition(self):
+        """ Return a stand-in for threading.Condition, whose wait() times out on this clock """
+        return VirtualCondition(self)
+
+    def _block(self, wake):
+        """ Block the current participant until the time is wake, or it is notified.  Called with _cond held. """
+        thread = threading.current_thread()
+        self._blocked[thread] = wake
+        self._advance()
+        while thread in self._blocked and (wake is None or self.now < wake):
+            self._cond.wait()
+        self._blocked.pop(thread, None)
+
+    def _advance(self):
+        if self._participants and len(self._blocked) == len(self._participants):
+            wakes = [wake for wake in self._blocked.values() if wake is not None]
+            if wakes:
+                self.now = max(self.now, min(wakes))
+                self._cond.notify_all()
+
+    def spawn(self, *functions):
+        """
+        Call each function in its own thread, sharing the clock.
+
+        :return: a join() function, which waits for the threads and returns their results in order, or raises the
+                 first error
+        """
+        results = [None] * len(functions)
+        errors = []
+        state = dict(running=len(functions), joiner=None)
+
+        def run(i, function):
+            try:
+                results[i] = function()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with self._cond:
+                    self._participants.discard(threading.current_thread())
+                    state['running'] -= 1
+                    # Hand the time back to the thread waiting for these, before anyone else can move it on
+                    if not state['running'] and state['joiner'] is not None:
+                        self._participants.add(state['joiner'])
+                    self._advance()
+
+        threads = [threading.Thread(target=run, args=(i, function)) for (i, function) in enumerate(functions)]
+        with self._cond:
+            self._participants.update(threads)
+        for thread in threads:
+            thread.start()
+
+        def join():
+            caller = threading.current_thread()
+            with self._cond:
+                if state['running'] and caller in self._participants:
+                    self._participants.discard(caller)
+                    state['joiner'] = caller
+                    self._advance()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            return results
+        return join
+
+    def run_concurrently(self, *functions):
+        """ Call each function in its own thread, sharing the clock, and return their results in order """
+        return self.spawn(*functions)()
+
+
+class VirtualCondition(object):
+    """ Stand-in for threading.Condition, sharing its VirtualClock's lock, whose wait() times out on the clock """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self._waiters = set()
+
+    def __enter__(self):
+        self.clock._cond.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.clock._cond.release()
+
+    def wait(self, timeout=None):
+        clock = self.clock
+        thread = threading.current_thread()
+        if thread not in clock._participants:
+            # As with sleep(), a thread the clock didn't start just moves the time on
+            if timeout is not None:
+                clock.now = max(clock.now, clock.now + timeout)
+            return
+        self._waiters.add(thread)
+        try:
+            clock._block(None if timeout is None else clock.now + timeout)
+        finally:
+            self._waiters.discard(thread)
+
+    def notify_all(self):
+        for thread in self._waiters:
+            self.clock._blocked.pop(thread, None)
+        self._waiters.clear()
+        self.clock._cond.notify_all()
+
+
+class VirtualThreadPool(object):
+    """
+    Stand-in for multiprocessing.pool.ThreadPool, whose worker threads are started by a VirtualClock.  Code that works
+    while map_async() runs should itself run in a thread the clock started, so that work is on the same timeline.
+    """
+
+    def __init__(self, clock, processes=None):
+        self.clock = clock
+        self.processes = processes or 1
+
+    def map_async(self, function, items):
+        items = list(items)
+        results = [None] * len(items)
+        queue = iter(enumerate(items))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    (i, item) = next(queue, (None, None))
+                if i is None:
+                    return
+                results[i] = function(item)
+
+        return VirtualAsyncResult(self.clock.spawn(*[worker] * min(self.processes, len(items))), results)
+
+    def map(self, function, items):
+        return self.map_async(function, items).get()
+
+    def close(self):
+        pass
+
+
+class VirtualAsyncResult(object):
+    def __init__(self, join, results):
+        self.join = join
+        self.results = results
+
+    def get(self, timeout=None):
+        self.join()
+        return self.results
+
+
+def watch(clock, watcher, function):
+    """ Run a StatusBroker and function together on the clock, stop the broker once function returns, and return its
+    result """
+    def call():
+        try:
+            return function()
+        finally:
+            watcher.stop()
+    return clock.run_concurrently(watcher.run, call)[1]
+
+
+class SimulatedCloud(CACPy):
+    """
+    Stand-in CloudAtCost API on a VirtualClock.
+
+    A new server is Installing for build_seconds (a number, or a list used one build at a time) before it is Powered
+    On.  Power changes take power_seconds, during which the server keeps its old status (Restarting, for a reset).
+    A reset only shows as Restarting after restart_delay seconds, as listservers can lag behind it.  Every call is
+    recorded in calls, with the time it was made.
+    """
+
+    def __init__(self, clock, servers=None, build_seconds=3600, power_seconds=30, restart_delay=0):
+        CACPy.__init__(self, 'test@user.com', 'secret')
+        self.clock = clock
+        self.build_seconds = build_seconds
+        self.power_seconds = power_seconds
+        self.restart_delay = restart_delay
+        self.servers = {}
+        self.pending = {}
+        self.calls = []
+        self._next_sid = 200000000
+        self._lock = threading.RLock()
+        for server in V1_LISTSERVERS_RESPONSE['data'] if servers is None else servers:
+            self.servers[server['sid']] = dict(server)
+
+    def _make_request(self, endpoint, options=dict(), type="GET"):
+        raise AssertionError("unexpected endpoint %s: SimulatedCloud doesn't make HTTP requests" % endpoint)
+
+    def _record(self, call):
+        self.calls.append((self.clock.now, call))
+
+    def count(self, call):
+        return len([c for (t, c) in self.calls if c == call])
+
+    def status(self, sid):
+        with self._lock:
+            server = self.servers[sid]
+            if sid in self.pending:
+                (start, until, during, after) = self.pending[sid]
+                if self.clock.now < start:
+                    return server['status']
+                if self.clock.now < until:
+                    return during
+                server['status'] = after
+                del self.pending[sid]
+            return server['status']
+
+    def _change(self, sid, seconds, during, after, delay=0):
+        with self._lock:
+            self.status(sid)
+            start = self.clock.now + delay
+            self.pending[sid] = (start, start + seconds, during, after)
+
+    def get_server_info(self):
+        with self._lock:
+            self._record('listservers')
+            data = [dict(server, status=self.status(sid)) for (sid, server) in sorted(self.servers.items())]
+        return dict(V1_LISTSERVERS_RESPONSE, data=data, time=int(self.clock.now))
+
+    def get_template_info(self):
+        self._record('listtemplates')
+        return V1_LIST_TEMPLATES_RESPONSE
+
+    def get_resources(self):
+        self._record('resources')
+        return V1_STANDARD_RESPONSE_OK
+
+    def server_build(self, cpu, ram, disk, os):
+        with self._lock:
+            self._record('build')
+            sid = str(self._next_sid)
+            self._next_sid += 1
+            servername = 'c%s-cloudpro-%s' % (sid, sid)
+            template = next(t['name'] for t in V1_LIST_TEMPLATES_RESPONSE['data'] if t['ce_id'] == str(os))
+            self.servers[sid] = dict(V1_LISTSERVERS_RESPONSE['data'][0], sid=sid, id=sid, servername=servername,
+                                     label='', cpu=str(cpu), ram=str(ram), storage=str(disk), template=template,
+                                     status='Installing')
+            seconds = self.build_seconds.pop(0) if isinstance(self.build_seconds, list) else self.build_seconds
+            self._change(sid, seconds, 'Installing', 'Powered On')
+        return dict(status='ok', result='successful', servername=servername, taskid=1, api='v1', action='build')
+
+    def power_on_server(self, server_id):
+        self._record('poweron')
+        self._change(server_id, self.power_seconds, self.status(server_id), 'Powered On')
+        return V1_STANDARD_RESPONSE_OK
+
+    def power_off_server(self, server_id):
+        self._record('poweroff')
+        self._change(server_id, self.power_seconds, self.status(server_id), 'Powered Off')
+        return V1_STANDARD_RESPONSE_OK
+
+    def reset_server(self, server_id):
+        self._record('reset')
+        self._change(server_id, self.power_seconds, 'Restarting', 'Powered On', self.restart_delay)
+        return V1_STANDARD_RESPONSE_OK
+
+    def rename_server(self, server_id, new_name):
+        self._record('rename')
+        with self._lock:
+            self.servers[server_id]['label'] = new_name
+        return V1_STANDARD_RESPONSE_OK
+
+    def change_hostname(self, server_id, new_hostname):
+        self._record('rdns')
+        with self._lock:
+            self.servers[server_id]['rdns'] = new_hostname
+        return V1_STANDARD_RESPONSE_OK
+
+    def set_run_mode(self, server_id, run_mode):
+        self._record('runmode')
+        with self._lock:
+            self.servers[server_id]['mode'] = run_mode.capitalize()
+        return V1_STANDARD_RESPONSE_OK
+
+    def server_delete(self, server_id):
+        self._record('delete')
+        with self._lock:
+            del self.servers[server_id]
+        return V1_DELETE_SUCCESS